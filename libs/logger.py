@@ -29,7 +29,7 @@ class Log:
             print(Colors.colorize(color, stackTrace), file=file)
 
         if level >= self.minimum_log_level:
-            self.logs_db.insert_log(level=level, method=method, message=message, stack=stackTrace)
+            self.logs_db.queue_log(level=level, method=method, message=message, stack=stackTrace)
 
     def debug(self, method: str, message: str, stackTrace: typing.Optional[str] = None):
         self.__write(level=LogLevel.DEBUG, method=method, message=message, stackTrace=stackTrace, file=sys.stdout)
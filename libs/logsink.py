@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import sys
+import threading
+import traceback
+import typing
+
+from libs import settings, utils
+from libs.colors import Colors
+from libs.enums.loglevel import LogLevel
+
+LogWriter = typing.Callable[[typing.List[dict]], typing.Awaitable[typing.Any]]
+
+
+class LogSink:
+    """Queues log entries in memory and writes them in batches from a background task"""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 2.0, max_queue_size: int = 10000) -> None:
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue_size = max(self.batch_size, max_queue_size)
+        # above this many queued entries, DEBUG entries are dropped to keep room for the more important ones
+        self.sample_threshold = self.max_queue_size // 2
+        self.dropped = 0
+        self._queue: typing.Deque[dict] = collections.deque()
+        self._writer: typing.Optional[LogWriter] = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._stopping = False
+
+    @classmethod
+    def get_instance(cls) -> "LogSink":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    log_sink = settings.Settings().log_sink
+                    cls._instance = LogSink(
+                        batch_size=log_sink["batch_size"],
+                        flush_interval=log_sink["flush_interval"],
+                        max_queue_size=log_sink["max_queue_size"],
+                    )
+        return cls._instance
+
+    def enqueue(self, entry: dict) -> None:
+        """Queue a log entry, never blocking: under backpressure entries are sampled, then dropped"""
+        queued = len(self._queue)
+        if queued >= self.max_queue_size or (
+            queued >= self.sample_threshold and entry.get("level") == LogLevel.DEBUG.name
+        ):
+            self.dropped += 1
+            return
+        self._queue.append(entry)
+        if self._wakeup is not None and queued + 1 >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self, writer: LogWriter) -> None:
+        """Start flushing to the writer from a background task on the running event loop"""
+        self._writer = writer
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()  # type: ignore
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write every queued entry, in batches of batch_size"""
+        if self._writer is None:
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self._queue.append(
+                {
+                    "timestamp": utils.get_timestamp(),
+                    "level": LogLevel.WARNING.name,
+                    "method": f"{self.__class__.__module__}.{self.__class__.__name__}.flush",
+                    "message": f"Dropped {dropped} log entries under backpressure",
+                    "stack_trace": "",
+                }
+            )
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            try:
+                await self._writer(batch)
+            except Exception as ex:
+                print(Colors.colorize(Colors.FAIL, f"Unable to write {len(batch)} log entries: {ex}"), file=sys.stderr)
+                print(Colors.colorize(Colors.FAIL, traceback.format_exc()), file=sys.stderr)
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Stop the background task after a last flush of what is queued, waiting at most timeout seconds"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()  # type: ignore
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            print(
+                Colors.colorize(Colors.FAIL, f"Timed out flushing logs, {len(self._queue)} entries lost"),
+                file=sys.stderr,
+            )
+        self._task = None
@@ -0,0 +1,39 @@
+import typing
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from libs import utils
+
+
+@dataclass
+class SleepSummary:
+    sleepRecordPatientId: str
+    lastReportDate: Optional[str] = None
+    totalUsageSeconds: int = 0
+    totalDaysCount: int = 0
+    totalDaysCountIncludingZero: int = 0
+    typename: str = field(default="SleepSummary", init=False)
+
+    def to_dict(self):
+        """Convert the dataclass to a dictionary."""
+        return asdict(self)
+
+    def daysCount(self, includeZero: bool = False) -> int:
+        """Get the total number of days, with or without the days that have a zero sleepScore."""
+        return self.totalDaysCountIncludingZero if includeZero else self.totalDaysCount
+
+    @staticmethod
+    def from_map(data: typing.Mapping[str, typing.Any]) -> 'SleepSummary':
+        """Create a SleepSummary instance from a mapping."""
+        return SleepSummary.from_dict(utils.map_to_dict(data))
+
+    @staticmethod
+    def from_dict(data: dict) -> 'SleepSummary':
+        """Create a SleepSummary instance from a dictionary."""
+        return SleepSummary(
+            sleepRecordPatientId=data.get("sleepRecordPatientId", ""),
+            lastReportDate=data.get("lastReportDate", None),
+            totalUsageSeconds=data.get("totalUsageSeconds", 0),
+            totalDaysCount=data.get("totalDaysCount", 0),
+            totalDaysCountIncludingZero=data.get("totalDaysCountIncludingZero", 0),
+        )
@@ -1,4 +1,3 @@
-import inspect
 import os
 import sys
 import traceback
@@ -7,7 +6,12 @@ import typing
 from libs import settings, utils
 from libs.colors import Colors
 from libs.enums import loglevel
+from libs.logsink import LogSink
 from libs.mongodb.MongoClientSingleton import MongoClientSingleton
+from pymongo.errors import OperationFailure
+
+# IndexOptionsConflict and IndexKeySpecsConflict, an index on the same keys already exists with other options
+INDEX_CONFLICT_CODES = (85, 86)
 
 
 class BaseDatabase:
@@ -20,6 +24,11 @@ class BaseDatabase:
         self.connection = None
         self.database_name = self.settings.db_name
         self.db_url = self.settings.db_url
+        self.collection_name: typing.Optional[str] = None
+        # index key lists created by ensure_indexes, e.g. [[("field", 1), ("other", -1)]]
+        self.indexes: typing.List[typing.List[typing.Tuple[str, int]]] = []
+        # same as indexes, created with unique=True
+        self.unique_indexes: typing.List[typing.List[typing.Tuple[str, int]]] = []
 
     def open(self) -> None:
         if not self.db_url:
@@ -29,17 +38,51 @@ class BaseDatabase:
         self.client = MongoClientSingleton.get_client(self.db_url)
         self.connection = self.client[self.database_name]
 
-    def close(self) -> None:
-        _method = inspect.stack()[0][3]
+    async def ensure_indexes(self) -> bool:
+        """Create the indexes of this collection, if they do not exist yet. False if that failed."""
+        _method = f"{self._module}.{self._class}.ensure_indexes"
+        try:
+            if not self.collection_name or not (self.indexes or self.unique_indexes):
+                return True
+            if self.connection is None or self.client is None:
+                self.open()
+            for keys in self.indexes:
+                await self.connection[self.collection_name].create_index(keys)  # type: ignore
+            for keys in self.unique_indexes:
+                try:
+                    await self.connection[self.collection_name].create_index(keys, unique=True)  # type: ignore
+                except OperationFailure as ex:
+                    if ex.code not in INDEX_CONFLICT_CODES:
+                        raise
+                    # created without unique by an older version, replace it
+                    self.log(
+                        level=loglevel.LogLevel.WARNING,
+                        method=_method,
+                        message=f"Replacing the index {keys} of {self.collection_name} with a unique one",
+                    )
+                    await self.connection[self.collection_name].drop_index(keys)  # type: ignore
+                    await self.connection[self.collection_name].create_index(keys, unique=True)  # type: ignore
+            return True
+        except Exception as ex:
+            self.log(
+                level=loglevel.LogLevel.ERROR,
+                method=_method,
+                message=f"Failed to create indexes: {ex}",
+                stackTrace=traceback.format_exc(),
+            )
+            return False
+
+    async def close(self) -> None:
+        _method = f"{self._module}.{self._class}.close"
         try:
             if self.client:
-                self.client.close()
+                await self.client.close()
             self.client = None
             self.connection = None
         except Exception as ex:
             self.log(
                 level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
+                method=_method,
                 message=f"Failed to close connection: {ex}",
                 stackTrace=traceback.format_exc(),
             )
@@ -53,7 +96,6 @@ class BaseDatabase:
         outIO: typing.Optional[typing.IO] = None,
         colorOverride: typing.Optional[str] = None,
     ) -> None:
-        _method = inspect.stack()[0][3]
         if colorOverride is None:
             color = Colors.get_color(level)
         else:
@@ -74,38 +116,27 @@ class BaseDatabase:
             print(Colors.colorize(color, stackTrace), file=stdoe)
         try:
             if level >= loglevel.LogLevel.INFO:
-                self.insert_log(level=level, method=method, message=message, stack=stackTrace)
+                self.queue_log(level=level, method=method, message=message, stack=stackTrace)
         except Exception as ex:
             self.log(
                 level=loglevel.LogLevel.PRINT,
-                method=f"{self._module}.{self._class}.{_method}",
+                method=f"{self._module}.{self._class}.log",
                 message=f"Unable to log to database: {ex}",
                 stackTrace=traceback.format_exc(),
                 outIO=sys.stderr,
                 colorOverride=Colors.FAIL,
             )
 
-    def insert_log(
+    def queue_log(
         self, level: loglevel.LogLevel, method: str, message: str, stack: typing.Optional[str] = None
     ) -> None:
-        _method = inspect.stack()[0][3]
-        try:
-            if self.connection is None or self.client is None:
-                self.open()
-            payload = {
+        """Queue the log entry for the batched database writer, so logging never waits on the database."""
+        LogSink.get_instance().enqueue(
+            {
                 "timestamp": utils.get_timestamp(),
                 "level": level.name,
                 "method": method,
                 "message": message,
                 "stack_trace": stack if stack else "",
             }
-            self.connection.logs.insert_one(payload)  # type: ignore
-        except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.PRINT,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"Failed to insert log: {ex}",
-                stackTrace=traceback.format_exc(),
-                outIO=sys.stderr,
-                colorOverride=Colors.FAIL,
-            )
+        )
@@ -3,7 +3,7 @@ import threading
 import typing
 
 from libs import utils
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
 
 
 class MongoClientSingleton:
@@ -20,13 +20,13 @@ class MongoClientSingleton:
                         db_url = utils.dict_get(
                             os.environ, "MONGODB_URL", default_value="mongodb://localhost:27017/tacobot"
                         )
-                    cls._instance = MongoClient(db_url)
+                    cls._instance = AsyncMongoClient(db_url)
         return cls._instance
 
     @classmethod
-    def close_client(cls):
-        if cls._instance is not None:
-            with cls._lock:
-                if cls._instance is not None:
-                    cls._instance.close()
-                    cls._instance = None
+    async def close_client(cls):
+        with cls._lock:
+            instance = cls._instance
+            cls._instance = None
+        if instance is not None:
+            await instance.close()
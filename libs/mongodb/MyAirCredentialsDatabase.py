@@ -0,0 +1,61 @@
+import os
+import traceback
+import typing
+
+from libs import utils
+from libs.enums import loglevel
+from libs.mongodb.Database import Database
+from libs.tracing import current_span, traced
+from pymongo.errors import DuplicateKeyError
+
+
+class MyAirCredentialsDatabase(Database):
+    def __init__(self) -> None:
+        super().__init__()
+        # get the file name without the extension and without the directory
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        self.collection_name = "myair_credentials"
+        # one credentials document per myAir account
+        self.unique_indexes = [[("key", 1)]]
+        pass
+
+    @traced
+    async def get(self, key: str) -> typing.Optional[dict]:
+        """Get the stored credentials (key, version, payload) for a key, or None if there are none."""
+        _method = current_span()
+        try:
+            if self.connection is None or self.client is None:
+                self.open()
+            return await self.connection[self.collection_name].find_one({"key": key}, {"_id": 0})  # type: ignore
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return None
+
+    @traced
+    async def save(self, key: str, payload: str, version: typing.Optional[int]) -> typing.Optional[int]:
+        """Store the credentials if the stored version is still the given one, returning the new version.
+
+        Returns None when another writer got there first, or the write failed.
+        """
+        _method = current_span()
+        try:
+            if self.connection is None or self.client is None:
+                self.open()
+            timestamp = utils.get_timestamp()
+            if version is None:
+                # the unique index turns a concurrent first write into a duplicate key error
+                await self.connection[self.collection_name].insert_one(  # type: ignore
+                    {"key": key, "version": 1, "payload": payload, "timestamp": timestamp}
+                )
+                return 1
+            result = await self.connection[self.collection_name].update_one(  # type: ignore
+                {"key": key, "version": version},
+                {"$set": {"payload": payload, "timestamp": timestamp}, "$inc": {"version": 1}},
+            )
+            return version + 1 if result.modified_count == 1 else None
+        except DuplicateKeyError:
+            return None
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return None
@@ -1,9 +1,12 @@
-import inspect
 import os
+import sys
 import traceback
+import typing
 
+from libs.colors import Colors
 from libs.enums import loglevel
 from libs.mongodb.Database import Database
+from libs.tracing import current_span, traced
 
 
 class MyAirLogsDatabase(Database):
@@ -15,18 +18,35 @@ class MyAirLogsDatabase(Database):
         self.collection_name = "myair_logs"
         pass
 
-    def get_logs(self) -> list:
+    @traced
+    async def get_logs(self) -> list:
         """Get all logs."""
-        _method = inspect.stack()[0][3]
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
-            return list(self.connection.logs.find({}))  # type: ignore
+            return await self.connection.logs.find({}).to_list()  # type: ignore
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return []
+
+    @traced
+    async def insert_logs(self, entries: typing.List[dict]) -> bool:
+        """Insert a batch of log entries."""
+        _method = current_span()
+        try:
+            if self.connection is None or self.client is None:
+                self.open()
+            if entries:
+                await self.connection.logs.insert_many(entries, ordered=False)  # type: ignore
+            return True
         except Exception as ex:
             self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
+                level=loglevel.LogLevel.PRINT,
+                method=_method,
+                message=f"Failed to insert logs: {ex}",
                 stackTrace=traceback.format_exc(),
+                outIO=sys.stderr,
+                colorOverride=Colors.FAIL,
             )
-            return []
+            return False
@@ -1,10 +1,10 @@
-import inspect
 import os
 import traceback
 
 from libs.enums import loglevel
 from libs.models.Patient import Patient
 from libs.mongodb.Database import Database
+from libs.tracing import current_span, traced
 
 
 class MyAirPatientsDatabase(Database):
@@ -14,47 +14,40 @@ class MyAirPatientsDatabase(Database):
         self._module = os.path.basename(__file__)[:-3]
         self._class = self.__class__.__name__
         self.collection_name = "myair_patients"
+        self.indexes = [[("id", 1)]]
         pass
 
-    def list(self) -> list:
+    @traced
+    async def list(self) -> list:
         """List all patients."""
-        _method = inspect.stack()[0][3]
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
 
-            patients = list(self.connection[self.collection_name].find({}))  # type: ignore
+            patients = await self.connection[self.collection_name].find({}).to_list()  # type: ignore
             return [Patient.from_dict(patient) for patient in patients]
         except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
             return []
 
-    def insert(self, patient: Patient) -> bool:
-        _method = inspect.stack()[0][3]
+    @traced
+    async def insert(self, patient: Patient) -> bool:
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
             # only insert if the patient does not already exist
-            existing_patient = self.connection[self.collection_name].find_one({"id": patient.id})  # type: ignore
+            existing_patient = await self.connection[self.collection_name].find_one({"id": patient.id})  # type: ignore
             if existing_patient:
                 self.log(
                     level=loglevel.LogLevel.INFO,
-                    method=f"{self._module}.{self._class}.{_method}",
+                    method=_method,
                     message=f"Patient {patient.id} already exists, skipping insert.",
                 )
                 return False
-            self.connection[self.collection_name].insert_one(patient.to_dict())  # type: ignore
+            await self.connection[self.collection_name].insert_one(patient.to_dict())  # type: ignore
             return True
         except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
             return False
@@ -0,0 +1,59 @@
+import os
+import traceback
+import typing
+
+from libs import utils
+from libs.enums import loglevel
+from libs.mongodb.Database import Database
+from libs.tracing import current_span, traced
+
+
+class MyAirSleepRecordMonthsDatabase(Database):
+    def __init__(self) -> None:
+        super().__init__()
+        # get the file name without the extension and without the directory
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        self.collection_name = "myair_sleep_record_months"
+        # one document per patient and month, concurrent upserts must not create a second one
+        self.unique_indexes = [[("patientId", 1), ("month", 1)]]
+        pass
+
+    @traced
+    async def get(self, patientId: str, month: str) -> typing.Optional[typing.List[dict]]:
+        """Get the cached sleep records of a closed month (YYYY-MM), or None if the month is not cached."""
+        _method = current_span()
+        try:
+            if self.connection is None or self.client is None:
+                self.open()
+            entry = await self.connection[self.collection_name].find_one({"patientId": patientId, "month": month})  # type: ignore
+            if entry:
+                return entry.get("items", [])
+            return None
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return None
+
+    @traced
+    async def insert(self, patientId: str, month: str, items: typing.List[typing.Mapping[str, typing.Any]]) -> bool:
+        """Cache the sleep records of a closed month (YYYY-MM)."""
+        _method = current_span()
+        try:
+            if self.connection is None or self.client is None:
+                self.open()
+            await self.connection[self.collection_name].update_one(  # type: ignore
+                {"patientId": patientId, "month": month},
+                {
+                    "$setOnInsert": {
+                        "patientId": patientId,
+                        "month": month,
+                        "items": [utils.map_to_dict(item) for item in items],
+                        "timestamp": utils.get_timestamp(),
+                    }
+                },
+                upsert=True,
+            )
+            return True
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return False
@@ -1,11 +1,13 @@
-import inspect
 import os
 import traceback
 import typing
 
 from libs.enums import loglevel
 from libs.models.SleepRecord import SleepRecord
+from libs.models.SleepSummary import SleepSummary
 from libs.mongodb.Database import Database
+from libs.tracing import current_span, traced
+from pymongo import UpdateOne
 
 
 class MyAirSleepRecordsDatabase(Database):
@@ -15,174 +17,122 @@ class MyAirSleepRecordsDatabase(Database):
         self._module = os.path.basename(__file__)[:-3]
         self._class = self.__class__.__name__
         self.collection_name = "myair_sleep_records"
+        self.indexes = [[("sleepRecordPatientId", 1), ("startDate", -1)]]
         pass
 
-    def getTotalUsageSeconds(self, patientId: str) -> int:
-        """Get the total usage time of a patient's device."""
-        _method = inspect.stack()[0][3]
+    @traced
+    async def getSummary(self, patientId: str) -> SleepSummary:
+        """Get the last report date, total usage and total days count of a patient in a single aggregation."""
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
-            if self.collection_name not in self.connection.list_collection_names():  # type: ignore
-                return 0
-            # sum the usage seconds for the given patient, and mask
-            cursor = self.connection[self.collection_name].aggregate(  # type: ignore
+            cursor = await self.connection[self.collection_name].aggregate(  # type: ignore
                 [
                     {"$match": {"sleepRecordPatientId": patientId}},
-                    {"$group": {"_id": None, "total": {"$sum": "$totalUsage"}}},
+                    {
+                        "$facet": {
+                            # only if the sleepScore is not 0
+                            "last": [
+                                {"$match": {"sleepScore": {"$ne": 0}}},
+                                {"$sort": {"startDate": -1}},
+                                {"$limit": 1},
+                                {"$project": {"_id": 0, "startDate": 1}},
+                            ],
+                            "totals": [
+                                {
+                                    "$group": {
+                                        "_id": None,
+                                        "totalUsage": {"$sum": "$totalUsage"},
+                                        "totalDaysCount": {"$sum": {"$cond": [{"$gte": ["$sleepScore", 1]}, 1, 0]}},
+                                        "totalDaysCountIncludingZero": {
+                                            "$sum": {"$cond": [{"$gte": ["$sleepScore", 0]}, 1, 0]}
+                                        },
+                                    }
+                                }
+                            ],
+                        }
+                    },
                 ]
             )
-            result = next(cursor, None)
-            return (result["total"] * 60) if result else 0
-        except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
-            return 0
-
-    def getTotalDaysCount(self, patientId: str, includeZero: bool = False) -> int:
-        """Get the total number of days a patient has used a device."""
-        _method = inspect.stack()[0][3]
-        try:
-            if self.connection is None or self.client is None:
-                self.open()
-            if self.collection_name not in self.connection.list_collection_names():  # type: ignore
-                return 0
-            # count the number of distinct dates for the given patient and device
-            count = self.connection[self.collection_name].count_documents(  # type: ignore
-                {"sleepRecordPatientId": patientId, "sleepScore": {"$gte": 0 if includeZero else 1}}
+            result = next(iter(await cursor.to_list(1)), None) or {}
+            last = result.get("last") or [{}]
+            totals = result.get("totals") or [{}]
+            return SleepSummary(
+                sleepRecordPatientId=patientId,
+                lastReportDate=last[0].get("startDate"),
+                # totalUsage is in minutes, convert to seconds
+                totalUsageSeconds=totals[0].get("totalUsage", 0) * 60,
+                totalDaysCount=totals[0].get("totalDaysCount", 0),
+                totalDaysCountIncludingZero=totals[0].get("totalDaysCountIncludingZero", 0),
             )
-            return count
         except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
-            return 0
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return SleepSummary(sleepRecordPatientId=patientId)
 
-    def getLastReportDate(self, patientId: str) -> str | None:
-        """Get the last report date for a patient."""
-        _method = inspect.stack()[0][3]
-        try:
-            if self.connection is None or self.client is None:
-                self.open()
-            if self.collection_name not in self.connection.list_collection_names():  # type: ignore
-                return None
-            # order by startDate descending
-            # only if the sleepScore is not 0
-            record = self.connection[self.collection_name].find_one(  # type: ignore
-                {"sleepRecordPatientId": patientId, "sleepScore": {"$ne": 0}}, sort=[("startDate", -1)]
-            )
-            if record:
-                return SleepRecord.from_dict(record).startDate
-            return None
-        except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
-            return None
-
-    def list(self) -> list[SleepRecord]:
+    @traced
+    async def list(self) -> list[SleepRecord]:
         """Get all sleep records."""
-        _method = inspect.stack()[0][3]
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
-            if self.collection_name not in self.connection.list_collection_names():  # type: ignore
-                return []
             # get the sleep records from the collection and return them as a list of models.SleepRecord
             records = self.connection[self.collection_name].find({})  # type: ignore
-            return [SleepRecord.from_dict(record) for record in records]
+            return [SleepRecord.from_dict(record) async for record in records]
         except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
             return []
 
-    def get(self, startDate: str, patientId: str) -> SleepRecord | None:
-        """Get a sleep record by its ID."""
-        _method = inspect.stack()[0][3]
+    @traced
+    async def getMaskCodes(self, patientId: str, startDates: typing.List[str]) -> typing.Dict[str, str]:
+        """Get the stored maskCode of each of the given nights of a patient, keyed by startDate."""
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
             if self.connection is None or self.client is None:
                 raise ValueError("Database connection is not open")
 
-            record = self.connection[self.collection_name].find_one(
-                {"startDate": startDate, "sleepRecordPatientId": patientId}
-            )  # type: ignore
-            if record:
-                return SleepRecord.from_dict(record)
-            return None
-        except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
+            cursor = self.connection[self.collection_name].find(  # type: ignore
+                {"sleepRecordPatientId": patientId, "startDate": {"$in": startDates}, "maskCode": {"$ne": None}},
+                {"_id": 0, "startDate": 1, "maskCode": 1},
             )
-            return None
+            return {record["startDate"]: record["maskCode"] async for record in cursor}
+        except Exception as ex:
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return {}
 
-    def insert_many(self, records: typing.List[SleepRecord]) -> None:
-        """Insert multiple sleep records into the database."""
-        _method = inspect.stack()[0][3]
+    @traced
+    async def insert_many(self, records: typing.List[SleepRecord]) -> bool:
+        """Upsert multiple sleep records into the database in a single bulk write."""
+        _method = current_span()
         try:
             if self.connection is None or self.client is None:
                 self.open()
             if self.connection is None or self.client is None:
                 raise ValueError("Database connection is not open")
 
-            # payloads = [record.to_dict() for record in records]
             if records:
-                for record in records:
-                    self.insert(record)
+                await self.connection[self.collection_name].bulk_write(  # type: ignore
+                    [
+                        UpdateOne(
+                            {"startDate": record.startDate, "sleepRecordPatientId": record.sleepRecordPatientId},
+                            self._upsert_pipeline(record),
+                            upsert=True,
+                        )
+                        for record in records
+                    ],
+                    ordered=False,
+                )
+            return True
         except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
-
-    def insert(self, record: SleepRecord) -> None:
-        """Insert a single sleep record into the database."""
-        _method = inspect.stack()[0][3]
-        try:
-            if self.connection is None or self.client is None:
-                self.open()
-            if self.connection is None or self.client is None:
-                raise ValueError("Database connection is not open")
-
-            # do not update the maskCode if it is already set
-            existing_record = self.connection[self.collection_name].find_one(
-                {"startDate": record.startDate, "sleepRecordPatientId": record.sleepRecordPatientId}
-            )  # type: ignore
-
-            if existing_record:
-                if existing_record.get("maskCode") is not None:
-                    # if the maskCode is already set, do not update it
-                    record.maskCode = existing_record["maskCode"]
+            self.log(level=loglevel.LogLevel.ERROR, method=_method, message=f"{ex}", stackTrace=traceback.format_exc())
+            return False
 
-            self.connection[self.collection_name].update_one(
-                {"startDate": record.startDate, "sleepRecordPatientId": record.sleepRecordPatientId},
-                {"$set": record.to_dict()},
-                upsert=True,
-            )
-        except Exception as ex:
-            self.log(
-                level=loglevel.LogLevel.ERROR,
-                method=f"{self._module}.{self._class}.{_method}",
-                message=f"{ex}",
-                stackTrace=traceback.format_exc(),
-            )
+    @staticmethod
+    def _upsert_pipeline(record: SleepRecord) -> typing.List[dict]:
+        """Build an update pipeline that sets the record, but does not update the maskCode if it is already set."""
+        payload = {key: {"$literal": value} for key, value in record.to_dict().items() if key != "maskCode"}
+        payload["maskCode"] = {"$ifNull": ["$maskCode", {"$literal": record.maskCode}]}
+        return [{"$set": payload}]
@@ -0,0 +1,238 @@
+"""Adaptive per-host request limiter for the myAir client."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import email.utils
+import logging
+import time
+from collections.abc import AsyncIterator
+
+from prometheus_client import Counter, Gauge
+
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+RATE_LIMIT = Gauge(
+    namespace="myair",
+    subsystem="client",
+    name="rate_limit_requests_per_second",
+    documentation="Current request rate allowed against the host",
+    labelnames=["host"],
+)
+
+CONCURRENCY_LIMIT = Gauge(
+    namespace="myair",
+    subsystem="client",
+    name="concurrency_limit",
+    documentation="Current number of requests allowed in flight against the host",
+    labelnames=["host"],
+)
+
+IN_FLIGHT = Gauge(
+    namespace="myair",
+    subsystem="client",
+    name="requests_in_flight",
+    documentation="Number of requests in flight against the host",
+    labelnames=["host"],
+)
+
+BACKOFFS = Counter(
+    namespace="myair",
+    subsystem="client",
+    name="backoffs",
+    documentation="Number of times the host's limits were cut, by reason: throttled, server_error or error",
+    labelnames=["host", "reason"],
+)
+
+# weight of a new sample in the host's usual latency, which sets the cooldown between two cuts
+LATENCY_EWMA_ALPHA: float = 0.05
+
+
+class HostLimiter:
+    """Token bucket plus an AIMD concurrency window for one host.
+
+    Both limits start at their ceilings. A 429, a 5xx or a failed request halves them, at most once per
+    cooldown, and every healthy response grows them back additively. Latency is not judged: one host serves
+    both small device queries and large month fetches, so a slow response says little about congestion.
+    """
+
+    def __init__(self, host: str, rate: float, burst: float, max_concurrency: int) -> None:
+        self.host = host
+        self.max_rate = rate
+        self.min_rate = rate / 20
+        self.burst = max(1.0, burst)
+        self.max_concurrency = max(1, max_concurrency)
+
+        self.rate = self.max_rate
+        self.window = float(self.max_concurrency)
+        self.in_flight = 0
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        # monotonic time before which nothing is sent, from a Retry-After header
+        self._blocked_until = 0.0
+        # no further cut until then, so a burst of 429s from one congestion episode only counts once
+        self._cooldown_until = 0.0
+        self._latency: float | None = None
+        self._condition = asyncio.Condition()
+        self._export()
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(self.window))
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def acquire(self) -> None:
+        """Wait for a free slot in the window and a token in the bucket."""
+        async with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                timeout: float | None
+                if now < self._blocked_until:
+                    timeout = self._blocked_until - now
+                elif self.in_flight >= self.concurrency:
+                    # woken by release()
+                    timeout = None
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    IN_FLIGHT.labels(host=self.host).set(self.in_flight)
+                    return
+                else:
+                    timeout = (1 - self._tokens) / self.rate
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._condition.wait(), timeout)
+
+    async def release(self, status: int | None, latency: float, retry_after: float | None = None) -> None:
+        """Give the slot back and adapt the limits to the outcome, a None status being a failed request."""
+        async with self._condition:
+            self.in_flight -= 1
+            IN_FLIGHT.labels(host=self.host).set(self.in_flight)
+            now = time.monotonic()
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+            if status == 429:
+                self._decrease(now, "throttled")
+            elif status is None:
+                self._decrease(now, "error")
+            elif status >= 500:
+                self._decrease(now, "server_error")
+            else:
+                self._increase()
+
+            if status is not None and status < 500:
+                self._latency = (
+                    latency if self._latency is None else self._latency + LATENCY_EWMA_ALPHA * (latency - self._latency)
+                )
+            self._condition.notify_all()
+
+    async def cancel(self) -> None:
+        """Give the slot back without judging the host, for a request cancelled on our side."""
+        async with self._condition:
+            self.in_flight -= 1
+            IN_FLIGHT.labels(host=self.host).set(self.in_flight)
+            self._condition.notify_all()
+
+    def _decrease(self, now: float, reason: str) -> None:
+        if now < self._cooldown_until:
+            return
+        self.window = max(1.0, self.window / 2)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = min(self._tokens, 1.0)
+        self._cooldown_until = now + max(1.0, self._latency or 0.0)
+        BACKOFFS.labels(host=self.host, reason=reason).inc()
+        _LOGGER.warning(
+            "Backing off %s (%s): %.2f requests/s, %d in flight", self.host, reason, self.rate, self.concurrency
+        )
+        self._export()
+
+    def _increase(self) -> None:
+        # one more slot per window's worth of healthy responses, and a twentieth of the ceiling rate each
+        self.window = min(float(self.max_concurrency), self.window + 1 / self.window)
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20 / self.window)
+        self._export()
+
+    def _export(self) -> None:
+        RATE_LIMIT.labels(host=self.host).set(self.rate)
+        CONCURRENCY_LIMIT.labels(host=self.host).set(self.concurrency)
+
+
+class HostLimiters:
+    """One HostLimiter per host, shared by every client in the process."""
+
+    def __init__(self, rate: float = 5.0, burst: float = 10.0, max_concurrency: int = 8) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self._limiters: dict[str, HostLimiter] = {}
+
+    def configure(self, rate: float, burst: float, max_concurrency: int) -> None:
+        """Set the ceilings of the hosts, before any request is made."""
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self._limiters.clear()
+
+    def get(self, host: str) -> HostLimiter:
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(host, self.rate, self.burst, self.max_concurrency)
+            self._limiters[host] = limiter
+        return limiter
+
+    @contextlib.asynccontextmanager
+    async def limit(self, host: str) -> AsyncIterator[RequestOutcome]:
+        """Hold a slot against the host for the duration of a request, reporting its outcome on exit."""
+        limiter = self.get(host)
+        await limiter.acquire()
+        outcome = RequestOutcome()
+        try:
+            yield outcome
+        except asyncio.CancelledError:
+            await limiter.cancel()
+            raise
+        except BaseException:
+            # a request that never got a response
+            if outcome.status is None:
+                outcome.latency = time.monotonic() - outcome.started
+            await limiter.release(outcome.status, outcome.latency, outcome.retry_after)
+            raise
+        else:
+            await limiter.release(outcome.status, outcome.latency, outcome.retry_after)
+
+
+class RequestOutcome:
+    """What the limiter learns from one request, filled in once its response headers arrive."""
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.status: int | None = None
+        self.latency = 0.0
+        self.retry_after: float | None = None
+
+    def record(self, status: int, retry_after: str | None = None) -> None:
+        self.status = status
+        self.latency = time.monotonic() - self.started
+        self.retry_after = parse_retry_after(retry_after)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Return the seconds to wait from a Retry-After header, in either of its formats."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+LIMITERS: HostLimiters = HostLimiters()
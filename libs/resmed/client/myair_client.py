@@ -29,6 +29,18 @@ class MyAirConfig(NamedTuple):
     device_token: str | None = None
 
 
+class PatientData(NamedTuple):
+    """Device, user, mask and sleep record data returned by a single getPatientWrapper query.
+
+    user and mask are None when the query left them out.
+    """
+
+    device: Mapping[str, Any]
+    user: Mapping[str, Any] | None
+    mask: Mapping[str, Any] | None
+    sleep_records: list[Mapping[str, Any]]
+
+
 class MyAirClient(ABC):
     """Basic myAir Client Class."""
 
@@ -1,32 +1,39 @@
 """REST Client for ResMed myAir Client."""
 
 import base64
+import contextlib
 import datetime
 import hashlib
 import logging
 import os
 import re
-from collections.abc import Mapping, MutableMapping
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Mapping, MutableMapping
 from http.cookies import SimpleCookie
 from typing import Any
-from urllib.parse import DefragResult, parse_qs, urldefrag
+from urllib.parse import DefragResult, parse_qs, urldefrag, urlsplit
 
 import jwt
-from aiohttp import ClientResponse, ClientSession
+from aiohttp import ClientResponse, ClientResponseError, ClientSession
 from aiohttp.http_exceptions import HttpProcessingError
 from libs.resmed.client.const import AUTH_NEEDS_MFA, AUTHN_SUCCESS, REGION_NA
 from libs.resmed.client.helpers import redact_dict
+from libs.resmed.client.limiter import LIMITERS
 from libs.resmed.client.myair_client import (
     AuthenticationError,
     IncompleteAccountError,
     MyAirClient,
     MyAirConfig,
     ParsingError,
+    PatientData,
 )
 from multidict import CIMultiDict
 
 _LOGGER: logging.Logger = logging.getLogger(__name__)
 
+# Treat the access token as expired this many seconds before its exp claim
+ACCESS_TOKEN_EXPIRY_LEEWAY: int = 60
+
 EU_CONFIG: Mapping[str, Any] = {
     # The name used in various queries
     "product": "myAir EU",
@@ -82,6 +89,64 @@ OAUTH_URLS: Mapping[str, Any] = {
     "userinfo_url": "https://{okta_url}/oauth2/{auth_server_id}/v1/userinfo",
 }
 
+# The getPatientWrapper selections, shared by the single purpose queries and the combined patient data query
+DEVICES_SELECTION: str = """
+                fgDevices {
+                    serialNumber
+                    deviceType
+                    lastSleepDataReportTime
+                    localizedName
+                    imagePath
+                    fgDeviceManufacturerName
+                    fgDevicePatientId
+                    __typename
+                }"""
+
+PATIENT_SELECTION: str = """
+                patient {
+                    id
+                    firstName
+                    lastName
+                    email
+                    dateOfBirth
+                    countryId
+                    timezoneId
+                    gender
+                    userEnteredAhi
+                    __typename
+                }"""
+
+MASKS_SELECTION: str = """
+                masks {
+                    maskManufacturerName
+                    maskCode
+                    maskType
+                    localizedName
+                    imagePath
+                    maskPatientId
+                    __typename
+                }"""
+
+SLEEP_RECORDS_SELECTION: str = """
+                sleepRecords(startMonth: \"N_DAYS_AGO\", endMonth: \"DATE\")
+                {
+                    items {
+                        startDate
+                        totalUsage
+                        sleepScore
+                        usageScore
+                        ahiScore
+                        maskScore
+                        leakScore
+                        ahi
+                        maskPairCount
+                        leakPercentile
+                        sleepRecordPatientId
+                        __typename
+                    }
+                    __typename
+                }"""
+
 
 class RESTClient(MyAirClient):
     """myAir uses oauth on Okta and AWS AppSync GraphQL."""
@@ -94,12 +159,15 @@ class RESTClient(MyAirClient):
         self._json_headers: dict[str, Any] = {"Content-Type": "application/json", "Accept": "application/json"}
         self._country_code: str | None = None
         self._access_token: str | None = None
+        self._access_token_expires_at: float | None = None
         self._id_token: str | None = None
         self._state_token: str | None = None
         self._session_token: str | None = None
         self._cookie_dt: str | None = self._config.device_token
         self._cookie_sid: str | None = None
         self._uses_mfa: bool = False
+        # awaited with export_state() after every token exchange, to persist the session outside the process
+        self.on_state_change: Callable[[dict[str, Any]], Awaitable[Any]] | None = None
         if self._config.region == REGION_NA:
             self._region_config: Mapping[str, Any] = NA_CONFIG
         else:
@@ -114,6 +182,53 @@ class RESTClient(MyAirClient):
         """Return the device token."""
         return self._cookie_dt
 
+    @property
+    def access_token_expires_at(self) -> float | None:
+        """Return the access token expiry as a unix timestamp, if known."""
+        return self._access_token_expires_at
+
+    def access_token_expires_in(self) -> float:
+        """Return the number of seconds until the access token expires, 0 if there is no usable token."""
+        if not self._access_token or self._access_token_expires_at is None:
+            return 0
+        return max(0.0, self._access_token_expires_at - time.time())
+
+    def is_access_token_valid(self, leeway: float = ACCESS_TOKEN_EXPIRY_LEEWAY) -> bool:
+        """Check locally, from the JWT exp claim, that the access token is valid for at least leeway seconds."""
+        return self.access_token_expires_in() > leeway
+
+    def export_state(self) -> dict[str, Any]:
+        """Return the Okta session state needed to resume without logging in again."""
+        return {
+            "access_token": self._access_token,
+            "access_token_expires_at": self._access_token_expires_at,
+            "id_token": self._id_token,
+            "cookie_dt": self._cookie_dt,
+            "cookie_sid": self._cookie_sid,
+            "country_code": self._country_code,
+            "uses_mfa": self._uses_mfa,
+        }
+
+    def restore_state(self, state: Mapping[str, Any]) -> None:
+        """Resume an Okta session from a state returned by export_state."""
+        self._access_token = state.get("access_token")
+        self._access_token_expires_at = state.get("access_token_expires_at")
+        self._id_token = state.get("id_token")
+        # a configured device token wins over a stored one
+        self._cookie_dt = self._config.device_token or state.get("cookie_dt")
+        self._cookie_sid = state.get("cookie_sid")
+        self._country_code = state.get("country_code")
+        self._uses_mfa = bool(state.get("uses_mfa", False))
+
+    async def _notify_state_change(self) -> None:
+        if self.on_state_change is None:
+            return
+        try:
+            await self.on_state_change(self.export_state())
+        except Exception as e:
+            # losing the persisted copy only costs a login on the next start, never fail the token exchange for it
+            _LOGGER.warning("Unable to persist session state. %s: %s", type(e).__name__, e)
+
     @property
     def _cookies(self) -> dict[str, Any]:
         cookies: dict[str, Any] = {}
@@ -138,8 +253,13 @@ class RESTClient(MyAirClient):
             await self._get_initial_dt()
         if self._cookie_dt is None and self._uses_mfa:
             _LOGGER.warning("Device Token isn't set. This will require frequent reauthentication.")
-        if self._access_token and await self._is_access_token_active():
+        if self._access_token and self.is_access_token_valid():
+            _LOGGER.info("Existing Access Token is still valid. Reusing")
             return AUTHN_SUCCESS
+        return await self.reauthenticate(initial)
+
+    async def reauthenticate(self, initial: bool | None = False) -> str:
+        """Run the authn flow and obtain a new access token, regardless of the current token state."""
         _LOGGER.info("Starting Authentication")
         status: str = await self._authn_check()
         if status == AUTH_NEEDS_MFA:
@@ -176,7 +296,7 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[is_email_verified] authorize_url: %s", userinfo_url)
         _LOGGER.debug("[is_email_verified] headers: %s", redact_dict(headers))
 
-        async with self._session.get(userinfo_url, headers=headers, allow_redirects=False) as userinfo_res:
+        async with self._request("GET", userinfo_url, headers=headers, allow_redirects=False) as userinfo_res:
             _LOGGER.debug("[is_email_verified] userinfo_res: %s", userinfo_res)
             userinfo_dict: MutableMapping[str, Any] = await userinfo_res.json()
             _LOGGER.debug("[is_email_verified] introspect_dict: %s", redact_dict(userinfo_dict))
@@ -186,6 +306,20 @@ class RESTClient(MyAirClient):
             return True
         return False
 
+    @contextlib.asynccontextmanager
+    async def _request(self, method: str, url: str, **kwargs: Any) -> AsyncIterator[ClientResponse]:
+        """Send a request within the host's rate and concurrency limits, which adapt to its response."""
+        async with LIMITERS.limit(urlsplit(url).hostname or url) as outcome:
+            try:
+                async with self._session.request(method, url, **kwargs) as response:
+                    outcome.record(response.status, response.headers.get("Retry-After"))
+                    yield response
+            except ClientResponseError as e:
+                # raised before the response reached us, when the session raises for status
+                if outcome.status is None:
+                    outcome.record(e.status, e.headers.get("Retry-After") if e.headers else None)
+                raise
+
     async def _extract_and_update_cookies(self, cookie_headers: list) -> None:
         cookies: dict[str, Any] = {}
         for header in cookie_headers:
@@ -212,7 +346,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_initial_dt] initial_dt_url: %s", initial_dt_url)
         _LOGGER.debug("[get_initial_dt] headers: %s", redact_dict(self._json_headers))
 
-        async with self._session.get(
+        async with self._request(
+            "GET",
             initial_dt_url,
             headers=self._json_headers,
             raise_for_status=False,  # This will likely return a 400 which is ok. Just need the device token.
@@ -238,8 +373,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[is_access_token_active] headers: %s", redact_dict(headers))
         _LOGGER.debug("[is_access_token_active] introspect_query: %s", redact_dict(introspect_query))
 
-        async with self._session.post(
-            introspect_url, headers=headers, data=introspect_query, cookies=self._cookies
+        async with self._request(
+            "POST", introspect_url, headers=headers, data=introspect_query, cookies=self._cookies
         ) as introspect_res:
             _LOGGER.debug("[is_access_token_active] introspect_res: %s", introspect_res)
             introspect_dict: MutableMapping[str, Any] = await introspect_res.json()
@@ -282,8 +417,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[authn_check] headers: %s", redact_dict(self._json_headers))
         _LOGGER.debug("[authn_check] json_query: %s", redact_dict(json_query))
 
-        async with self._session.post(
-            authn_url, headers=self._json_headers, json=json_query, cookies=self._cookies
+        async with self._request(
+            "POST", authn_url, headers=self._json_headers, json=json_query, cookies=self._cookies
         ) as authn_res:
             _LOGGER.debug("[authn_check] authn_res: %s", authn_res)
             authn_dict: MutableMapping[str, Any] = await authn_res.json()
@@ -326,8 +461,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[trigger_mfa] headers: %s", redact_dict(self._json_headers))
         _LOGGER.debug("[trigger_mfa] json_query: %s", redact_dict(json_query))
 
-        async with self._session.post(
-            self._mfa_url, headers=self._json_headers, json=json_query, cookies=self._cookies
+        async with self._request(
+            "POST", self._mfa_url, headers=self._json_headers, json=json_query, cookies=self._cookies
         ) as trigger_mfa_res:
             _LOGGER.debug("[trigger_mfa] trigger_mfa_res: %s", trigger_mfa_res)
             trigger_mfa_dict: MutableMapping[str, Any] = await trigger_mfa_res.json()
@@ -343,8 +478,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[verify_mfa] headers: %s", redact_dict(self._json_headers))
         _LOGGER.debug("[verify_mfa] json_query: %s", json_query)
 
-        async with self._session.post(
-            self._mfa_url, headers=self._json_headers, json=json_query, cookies=self._cookies
+        async with self._request(
+            "POST", self._mfa_url, headers=self._json_headers, json=json_query, cookies=self._cookies
         ) as verify_mfa_res:
             _LOGGER.debug("[verify_mfa] verify_mfa_res: %s", verify_mfa_res)
             verify_mfa_dict: MutableMapping[str, Any] = await verify_mfa_res.json()
@@ -395,8 +530,13 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_access_token code] headers: %s", redact_dict(self._json_headers))
         _LOGGER.debug("[get_access_token code] params_query: %s", redact_dict(params_query))
 
-        async with self._session.get(
-            authorize_url, headers=self._json_headers, allow_redirects=False, params=params_query, cookies=self._cookies
+        async with self._request(
+            "GET",
+            authorize_url,
+            headers=self._json_headers,
+            allow_redirects=False,
+            params=params_query,
+            cookies=self._cookies,
         ) as code_res:
             _LOGGER.debug("[get_access_token] code_res: %s", code_res)
             if "location" not in code_res.headers:
@@ -429,8 +569,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_access_token token] headers: %s", redact_dict(headers))
         _LOGGER.debug("[get_access_token token] token_query: %s", redact_dict(token_query))
 
-        async with self._session.post(
-            token_url, headers=headers, data=token_query, allow_redirects=False, cookies=self._cookies
+        async with self._request(
+            "POST", token_url, headers=headers, data=token_query, allow_redirects=False, cookies=self._cookies
         ) as token_res:
             _LOGGER.debug("[get_access_token] token_res: %s", token_res)
             token_dict: MutableMapping[str, Any] = await token_res.json()
@@ -445,6 +585,23 @@ class RESTClient(MyAirClient):
                 if self._access_token is not None:
                     _LOGGER.info("Obtained new access token")
                 self._access_token = token_dict.get("access_token", self._access_token)
+            self._access_token_expires_at = RESTClient._decode_token_expiry(self._access_token, token_dict)
+        await self._notify_state_change()
+
+    @staticmethod
+    def _decode_token_expiry(access_token: str | None, token_dict: Mapping[str, Any]) -> float | None:
+        """Read the exp claim of the access token, falling back to the expires_in of the token response."""
+        if access_token:
+            try:
+                # We trust this JWT because it is myAir giving it to us, we only need the exp claim
+                jwt_data: Mapping[str, Any] = jwt.decode(access_token, options={"verify_signature": False})
+                if "exp" in jwt_data:
+                    return float(jwt_data["exp"])
+            except Exception as e:
+                _LOGGER.debug("[decode_token_expiry] unable to decode access_token. %s: %s", type(e).__name__, e)
+        if token_dict.get("expires_in"):
+            return time.time() + float(token_dict["expires_in"])
+        return None
 
     async def _gql_query(
         self, operation_name: str, query: str, initial: bool | None = False
@@ -496,7 +653,7 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[gql_query] headers: %s", redact_dict(headers))
         _LOGGER.debug("[gql_query] json_query: %s", redact_dict(json_query))
 
-        async with self._session.post(graphql_url, headers=headers, json=json_query) as records_res:
+        async with self._request("POST", graphql_url, headers=headers, json=json_query) as records_res:
             _LOGGER.debug("[gql_query] records_res: %s", records_res)
             records_dict: MutableMapping[str, Any] = await records_res.json()
             _LOGGER.debug("[gql_query] records_dict: %s", redact_dict(records_dict))
@@ -504,49 +661,124 @@ class RESTClient(MyAirClient):
 
         return records_dict
 
-    async def get_sleep_records(self, months: int = 1, initial: bool | None = False) -> list[Mapping[str, Any]]:
-        """Get sleep records from ResMed servers."""
+    @staticmethod
+    def _sleep_records_range(
+        months: int, start_date: str | None = None, end_date: str | None = None
+    ) -> tuple[str, str]:
+        """Return the (start, end) dates covering the requested number of months, or from start_date to end_date."""
+        if start_date:
+            return start_date, end_date or datetime.datetime.now().strftime("%Y-%m-%d")
         months_count: int = months - 1 if months - 1 >= 0 else 0
         today: str = datetime.datetime.now().strftime("%Y-%m-%d")
         days_ago: str = (datetime.datetime.now() - datetime.timedelta(days=months_count * 30)).strftime("%Y-%m-%d")
+        return days_ago, today
 
-        query: str = (
-            """query GetPatientSleepRecords {
-            getPatientWrapper {
-                patient {
+    @staticmethod
+    def _sleep_records_selection(start_date: str, end_date: str) -> str:
+        return SLEEP_RECORDS_SELECTION.replace("N_DAYS_AGO", start_date).replace("DATE", end_date)
+
+    async def get_sleep_records(
+        self, months: int = 1, initial: bool | None = False, start_date: str | None = None, end_date: str | None = None
+    ) -> list[Mapping[str, Any]]:
+        """Get sleep records from ResMed servers."""
+        start_date, end_date = RESTClient._sleep_records_range(months, start_date, end_date)
+
+        query: str = f"""query GetPatientSleepRecords {{
+            getPatientWrapper {{
+                patient {{
                     firstName
-                }
-                sleepRecords(startMonth: \"N_DAYS_AGO\", endMonth: \"DATE\")
-                {
-                    items {
-                        startDate
-                        totalUsage
-                        sleepScore
-                        usageScore
-                        ahiScore
-                        maskScore
-                        leakScore
-                        ahi
-                        maskPairCount
-                        leakPercentile
-                        sleepRecordPatientId
-                        __typename
-                    }
-                    __typename
-                }
+                }}
+                {RESTClient._sleep_records_selection(start_date, end_date)}
             __typename
-            }
-        }
-        """.replace(
-                "N_DAYS_AGO", days_ago
-            ).replace(
-                "DATE", today
-            )
-        )
+            }}
+        }}
+        """
 
         _LOGGER.info("Getting Sleep Records")
         records_dict: MutableMapping[str, Any] = await self._gql_query("GetPatientSleepRecords", query, initial)
         _LOGGER.debug("[get_sleep_records] records_dict: %s", redact_dict(records_dict))
+        return RESTClient._parse_sleep_records(records_dict)
+
+    async def get_mask_info(self, initial: bool | None = False) -> Mapping[str, Any]:
+        """Get mask info from ResMed servers."""
+        query: str = f"""
+            query getPatientWrapper {{
+                getPatientWrapper {{
+                    {MASKS_SELECTION}
+                }}
+            }}
+        """
+
+        _LOGGER.info("Getting Mask Info")
+        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
+        _LOGGER.debug("[get_mask_info] records_dict: %s", redact_dict(records_dict))
+        return RESTClient._parse_mask_info(records_dict)
+
+    async def get_user_info(self, initial: bool | None = False) -> Mapping[str, Any]:
+        """Get user info from ResMed servers."""
+        query: str = f"""
+        query getPatientWrapper {{
+            getPatientWrapper {{
+                {PATIENT_SELECTION}
+            }}
+        }}
+        """
+
+        _LOGGER.info("Getting User Info")
+        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
+        _LOGGER.debug("[get_user_info] records_dict: %s", redact_dict(records_dict))
+        return RESTClient._parse_user_info(records_dict)
+
+    async def get_user_device_data(self, initial: bool | None = False) -> Mapping[str, Any]:
+        """Get user device data from ResMed servers."""
+        query: str = f"""
+        query getPatientWrapper {{
+            getPatientWrapper {{
+                {DEVICES_SELECTION}
+            }}
+        }}
+        """
+
+        _LOGGER.info("Getting User Device Data")
+        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
+        _LOGGER.debug("[get_user_device_data] records_dict: %s", redact_dict(records_dict))
+        return RESTClient._parse_user_device_data(records_dict)
+
+    async def get_patient_data(
+        self,
+        months: int = 1,
+        initial: bool | None = False,
+        start_date: str | None = None,
+        include_user: bool = True,
+        include_mask: bool = True,
+    ) -> PatientData:
+        """Get device data, sleep records and, unless excluded, user and mask info from ResMed servers in one query."""
+        start_date, end_date = RESTClient._sleep_records_range(months, start_date)
+
+        query: str = f"""
+        query getPatientWrapper {{
+            getPatientWrapper {{
+                {DEVICES_SELECTION}
+                {PATIENT_SELECTION if include_user else ""}
+                {MASKS_SELECTION if include_mask else ""}
+                {RESTClient._sleep_records_selection(start_date, end_date)}
+                __typename
+            }}
+        }}
+        """
+
+        _LOGGER.info("Getting Patient Data")
+        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
+        _LOGGER.debug("[get_patient_data] records_dict: %s", redact_dict(records_dict))
+        return PatientData(
+            device=RESTClient._parse_user_device_data(records_dict),
+            user=RESTClient._parse_user_info(records_dict) if include_user else None,
+            mask=RESTClient._parse_mask_info(records_dict) if include_mask else None,
+            sleep_records=RESTClient._parse_sleep_records(records_dict),
+        )
+
+    @staticmethod
+    def _parse_sleep_records(records_dict: Mapping[str, Any]) -> list[Mapping[str, Any]]:
         try:
             records: list[Mapping[str, Any]] = records_dict["data"]["getPatientWrapper"]["sleepRecords"]["items"]
         except Exception as e:
@@ -558,27 +790,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_sleep_records] records: %s", redact_dict(records))
         return records
 
-    async def get_mask_info(self, initial: bool | None = False) -> Mapping[str, Any]:
-        """Get mask info from ResMed servers."""
-        query: str = """
-            query getPatientWrapper {
-                getPatientWrapper {
-                    masks {
-                        maskManufacturerName
-                        maskCode
-                        maskType
-                        localizedName
-                        imagePath
-                        maskPatientId
-                        __typename
-                    }
-                }
-            }
-        """
-
-        _LOGGER.info("Getting Mask Info")
-        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
-        _LOGGER.debug("[get_mask_info] records_dict: %s", redact_dict(records_dict))
+    @staticmethod
+    def _parse_mask_info(records_dict: Mapping[str, Any]) -> Mapping[str, Any]:
         try:
             mask_info: Mapping[str, Any] = records_dict["data"]["getPatientWrapper"]["masks"][0]
         except Exception as e:
@@ -590,30 +803,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_mask_info] mask_info: %s", redact_dict(mask_info))
         return mask_info
 
-    async def get_user_info(self, initial: bool | None = False) -> Mapping[str, Any]:
-        """Get user info from ResMed servers."""
-        query: str = """
-        query getPatientWrapper {
-            getPatientWrapper {
-                patient {
-                    id
-                    firstName
-                    lastName
-                    email
-                    dateOfBirth
-                    countryId
-                    timezoneId
-                    gender
-                    userEnteredAhi
-                    __typename
-                }
-            }
-        }
-        """
-
-        _LOGGER.info("Getting User Info")
-        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
-        _LOGGER.debug("[get_user_info] records_dict: %s", redact_dict(records_dict))
+    @staticmethod
+    def _parse_user_info(records_dict: Mapping[str, Any]) -> Mapping[str, Any]:
         try:
             user_info: Mapping[str, Any] = records_dict["data"]["getPatientWrapper"]["patient"]
         except Exception as e:
@@ -625,28 +816,8 @@ class RESTClient(MyAirClient):
         _LOGGER.debug("[get_user_info] user_info: %s", redact_dict(user_info))
         return user_info
 
-    async def get_user_device_data(self, initial: bool | None = False) -> Mapping[str, Any]:
-        """Get user device data from ResMed servers."""
-        query: str = """
-        query getPatientWrapper {
-            getPatientWrapper {
-                fgDevices {
-                    serialNumber
-                    deviceType
-                    lastSleepDataReportTime
-                    localizedName
-                    imagePath
-                    fgDeviceManufacturerName
-                    fgDevicePatientId
-                    __typename
-                }
-            }
-        }
-        """
-
-        _LOGGER.info("Getting User Device Data")
-        records_dict: MutableMapping[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
-        _LOGGER.debug("[get_user_device_data] records_dict: %s", redact_dict(records_dict))
+    @staticmethod
+    def _parse_user_device_data(records_dict: Mapping[str, Any]) -> Mapping[str, Any]:
         try:
             device: Mapping[str, Any] = records_dict["data"]["getPatientWrapper"]["fgDevices"][0]
         except Exception as e:
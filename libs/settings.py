@@ -16,6 +16,22 @@ class Settings:
         self.name = None
         self.version = None
         self.log_level = utils.dict_get(os.environ, 'MAE_LOG_LEVEL', default_value='DEBUG')
+        # seconds to drain the server, clients, queued logs and MongoDB on shutdown
+        self.shutdown_timeout = float(utils.dict_get(os.environ, "MAE_SHUTDOWN_TIMEOUT", default_value='10') or 10)
+        # batched database log writer
+        self.log_sink = {
+            "batch_size": int(utils.dict_get(os.environ, "MAE_LOG_BATCH_SIZE", default_value='100') or 100),
+            "flush_interval": float(utils.dict_get(os.environ, "MAE_LOG_FLUSH_INTERVAL", default_value='2') or 2),
+            "max_queue_size": int(utils.dict_get(os.environ, "MAE_LOG_MAX_QUEUE_SIZE", default_value='10000') or 10000),
+        }
+
+        # encrypted Okta session store, disabled without a key
+        self.credentials = {
+            # a Fernet key, e.g. from: python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+            "key": utils.dict_get(os.environ, "MAE_CREDENTIALS_KEY", default_value=None),
+            # the file copy, used when MongoDB is unavailable
+            "path": utils.dict_get(os.environ, "MAE_CREDENTIALS_PATH", default_value="/data/credentials"),
+        }
 
         # build db_url from environment variables:
         # MAE_MONGODB_USERNAME
@@ -47,6 +63,57 @@ class Settings:
             "records_days": int(
                 utils.dict_get(os.environ, "MAE_MYAIR_RECORDS_DAYS", default_value='90', required=True) or 90
             ),
+            # maximum number of exported series across all users, the oldest nights are evicted beyond it
+            "max_series": int(utils.dict_get(os.environ, "MAE_MYAIR_MAX_SERIES", default_value='10000') or 10000),
+            # days of overlap for the incremental sleep record window, to pick up late-arriving corrections
+            "records_overlap_days": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_RECORDS_OVERLAP_DAYS", default_value='3')
+            ),
+            # seconds between full reconciliations of records_days, default to once a day
+            "full_sync_interval": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_FULL_SYNC_INTERVAL", default_value='86400') or 86400
+            ),
+            # longest delay between polls of a user while backing off, default to an hour
+            "poll_max_interval": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_POLL_MAX_INTERVAL", default_value='3600') or 3600
+            ),
+            # seconds either side of the expected daily upload polled every polling interval, default to an hour
+            "upload_window": int(utils.dict_get(os.environ, "MAE_MYAIR_UPLOAD_WINDOW", default_value='3600') or 3600),
+            # random spread applied to every poll delay, as a fraction of it
+            "poll_jitter": float(utils.dict_get(os.environ, "MAE_MYAIR_POLL_JITTER", default_value='0.1')),
+            # seconds a device-only probe may stand in for a full fetch, default to 6 hours
+            "staleness_interval": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_STALENESS_INTERVAL", default_value='21600') or 21600
+            ),
+            # seconds the patient info, mask info and device catalog are reused before they are fetched again
+            "patient_ttl": int(utils.dict_get(os.environ, "MAE_MYAIR_PATIENT_TTL", default_value='86400') or 86400),
+            "mask_ttl": int(utils.dict_get(os.environ, "MAE_MYAIR_MASK_TTL", default_value='21600') or 21600),
+            "device_ttl": int(utils.dict_get(os.environ, "MAE_MYAIR_DEVICE_TTL", default_value='86400') or 86400),
+            # maximum number of users polled at the same time, default to 4
+            "max_concurrent_users": max(
+                1, int(utils.dict_get(os.environ, "MAE_MYAIR_MAX_CONCURRENT_USERS", default_value='4') or 4)
+            ),
+            # re-authenticate this many seconds before the access token expires, default to 5 minutes
+            "token_refresh_ahead": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_TOKEN_REFRESH_AHEAD", default_value='300') or 300
+            ),
+            # shared connection pool for all myAir traffic
+            "http_limit": int(utils.dict_get(os.environ, "MAE_MYAIR_HTTP_LIMIT", default_value='100') or 100),
+            "http_limit_per_host": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_HTTP_LIMIT_PER_HOST", default_value='10') or 10
+            ),
+            "http_dns_cache_ttl": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_HTTP_DNS_CACHE_TTL", default_value='300') or 300
+            ),
+            "http_keepalive_timeout": float(
+                utils.dict_get(os.environ, "MAE_MYAIR_HTTP_KEEPALIVE_TIMEOUT", default_value='60') or 60
+            ),
+            # ceilings of the adaptive per-host limiter, cut on throttling, errors or slow responses and regrown slowly
+            "rate_limit": float(utils.dict_get(os.environ, "MAE_MYAIR_RATE_LIMIT", default_value='5') or 5),
+            "rate_burst": float(utils.dict_get(os.environ, "MAE_MYAIR_RATE_BURST", default_value='10') or 10),
+            "max_requests_per_host": int(
+                utils.dict_get(os.environ, "MAE_MYAIR_MAX_REQUESTS_PER_HOST", default_value='8') or 8
+            ),
             "users": [],
         }
 
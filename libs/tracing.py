@@ -0,0 +1,71 @@
+import contextvars
+import functools
+import inspect
+import time
+import typing
+
+from prometheus_client import Histogram
+
+SPAN_DURATION = Histogram(
+    namespace="myair",
+    subsystem="exporter",
+    name="span_duration_seconds",
+    documentation="Duration of the exporter's traced methods in seconds",
+    labelnames=["span"],
+    # a handful of buckets from a quick MongoDB call to a full myAir fetch, every traced method pays for each of them
+    buckets=(0.005, 0.05, 0.5, 5.0, 30.0),
+)
+
+_current_span: contextvars.ContextVar[str] = contextvars.ContextVar("current_span", default="")
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+def span_name(func: typing.Callable) -> str:
+    """The {module}.{qualname} name used for the span of a function, e.g. myair.MyAirMetrics.fetch"""
+    module = func.__module__.rsplit(".", 1)[-1]
+    return f"{module}.{func.__qualname__}"
+
+
+def current_span() -> str:
+    """The name of the innermost span running in the current context"""
+    return _current_span.get()
+
+
+def traced(func: F) -> F:
+    """Decorator recording a span around every call, named once at definition time"""
+    name = span_name(func)
+    # the labelled child is created on the first call, a method that never runs exports no series
+    histogram: typing.Optional[Histogram] = None
+
+    def observe(elapsed: float) -> None:
+        nonlocal histogram
+        if histogram is None:
+            histogram = SPAN_DURATION.labels(span=name)
+        histogram.observe(elapsed)
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            token = _current_span.set(name)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - start)
+                _current_span.reset(token)
+
+        return typing.cast(F, async_wrapper)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe(time.perf_counter() - start)
+            _current_span.reset(token)
+
+    return typing.cast(F, wrapper)
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import json
 import math
 import random
@@ -28,6 +29,18 @@ def map_to_dict(input: typing.Mapping[str, typing.Any]) -> dict:
         raise TypeError("Input must be a mapping type with items() method.")
 
 
+def fingerprint(input: typing.Any) -> str:
+    """A short content hash of a JSON-like value, independent of key order."""
+    return hashlib.blake2b(
+        json.dumps(input, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def user_hash(user: typing.Mapping[str, typing.Any]) -> str:
+    """A stable pseudonym of a myAir account, for anything stored or exported outside the process."""
+    return hashlib.blake2b(f"{user['region']}:{user['username']}".encode("utf-8"), digest_size=16).hexdigest()
+
+
 def get_scalar_result(conn, sql, default_value=None, *args) -> typing.Any:
     cursor = conn.cursor()
     try:
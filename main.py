@@ -1,56 +1,63 @@
 import asyncio
 import os
 import signal
-from concurrent.futures import ProcessPoolExecutor
+import sys
+import typing
 
 from dotenv import find_dotenv, load_dotenv
 from libs.colors import Colors
 from metrics.exporter import MetricsExporter
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv(find_dotenv())
 
 
-def sighandler(signum: int, frame):
-    match signum:
-        case signal.SIGTERM:
-            print(Colors.colorize(Colors.FGYELLOW, "<SIGTERM received>"))
-        case signal.SIGINT:
-            print(Colors.colorize(Colors.FGYELLOW, "<SIGINT received>"))
-    exit(0)
+async def exporter() -> int:
+    """Run the exporter until it fails or a signal cancels it, returning the process exit status"""
+    EXPORTER_ENABLED = os.environ.get("MAE_CONFIG_METRICS_ENABLED", "false").lower() == "true"
+    if not EXPORTER_ENABLED:
+        print(Colors.colorize(Colors.FGYELLOW, "<Metrics exporter disabled>"))
+        return 0
 
+    metrics_exporter = MetricsExporter()
+    task = asyncio.create_task(metrics_exporter.run())
+    received: typing.List[int] = []
 
-async def exporter():
-    try:
-        EXPORTER_ENABLED = os.environ.get("MAE_CONFIG_METRICS_ENABLED", "false").lower() == "true"
-        if EXPORTER_ENABLED:
-            exporter = MetricsExporter()
+    def sighandler(signum: int) -> None:
+        match signum:
+            case signal.SIGTERM:
+                print(Colors.colorize(Colors.FGYELLOW, "<SIGTERM received>"))
+            case signal.SIGINT:
+                print(Colors.colorize(Colors.FGYELLOW, "<SIGINT received>"))
+        received.append(signum)
+        # cancels the in-flight polls, the exporter drains the server, logs and MongoDB on the way out
+        task.cancel()
 
-            await exporter.run()
-        else:
-            print(Colors.colorize(Colors.FGYELLOW, "<Metrics exporter disabled>"))
-    except KeyboardInterrupt:
-        print(Colors.colorize(Colors.FGYELLOW, "<KeyboardInterrupt received>"))
-        exit(0)
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signum, sighandler, signum)
 
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not received:
+            raise
+    finally:
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.remove_signal_handler(signum)
+    return metrics_exporter.exit_code
 
-def run_exporter_sync():
-    asyncio.run(exporter())
+
+def main() -> int:
+    if uvloop is not None:
+        # the faster loop is optional, the exporter runs the same on the default one
+        return uvloop.run(exporter())
+    return asyncio.run(exporter())
 
 
 if __name__ == '__main__':
-    # Explicitly create and set the event loop to avoid DeprecationWarning
-    # in Python 3.10+ when no current event loop exists in this thread.
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        signal.signal(signal.SIGTERM, sighandler)
-        signal.signal(signal.SIGINT, sighandler)
-
-        executor = ProcessPoolExecutor(2)
-        loop.run_in_executor(executor, run_exporter_sync)
-        loop.run_forever()
-    except KeyboardInterrupt:
-        print(Colors.colorize(Colors.FGYELLOW, "<KeyboardInterrupt received>"))
-        pass
-    finally:
-        loop.close()
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import os
+import ssl
+import traceback
+import typing
+
+import aiohttp
+from libs import settings
+from libs.enums.loglevel import LogLevel
+from libs.logger import Log
+from libs.resmed.client.limiter import LIMITERS
+from libs.resmed.client.myair_client import MyAirConfig
+from libs.resmed.client.rest_client import RESTClient
+from metrics.credentials import CredentialStore
+
+
+class CachedClient:
+    def __init__(self, user: dict, client: RESTClient) -> None:
+        self.user = user
+        self.client = client
+        # serializes connect/reauthenticate so a poll never races the background refresh
+        self.lock = asyncio.Lock()
+        self.refresh_task: typing.Optional[asyncio.Task] = None
+
+
+class MyAirClientCache:
+    """Keeps one authenticated RESTClient per myAir user alive between poll cycles"""
+
+    def __init__(self, refresh_ahead_seconds: int) -> None:
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        _method = f"{self._module}.{self._class}.__init__"
+
+        self.settings = settings.Settings()
+        log_level = LogLevel[self.settings.log_level.upper()]
+        if not log_level:
+            log_level = LogLevel.DEBUG
+        self.log = Log(minimumLogLevel=log_level)
+
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self._entries: typing.Dict[str, CachedClient] = {}
+        self._connector: typing.Optional[aiohttp.TCPConnector] = None
+        # sessions persisted across restarts and shared between replicas
+        self.credentials = CredentialStore()
+        # every client shares one adaptive limiter per myAir host
+        LIMITERS.configure(
+            rate=self.settings.myair["rate_limit"],
+            burst=self.settings.myair["rate_burst"],
+            max_concurrency=self.settings.myair["max_requests_per_host"],
+        )
+
+        self.log.debug(_method, "Client cache initialized")
+
+    @staticmethod
+    def _key(user: dict) -> str:
+        return f"{user['region']}:{user['username']}"
+
+    def _get_connector(self) -> aiohttp.TCPConnector:
+        """One long-lived connection pool for all myAir traffic, so keep-alive connections survive polls"""
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.settings.myair["http_limit"],
+                limit_per_host=self.settings.myair["http_limit_per_host"],
+                ttl_dns_cache=self.settings.myair["http_dns_cache_ttl"],
+                keepalive_timeout=self.settings.myair["http_keepalive_timeout"],
+                # a single context loads the CA store once, handshakes are only saved by reusing pooled connections
+                ssl=ssl.create_default_context(),
+            )
+        return self._connector
+
+    def _create_clientsession(self, **kwargs) -> aiohttp.ClientSession:
+        # every user gets its own session, and so its own cookie jar, on top of the shared connector
+        return aiohttp.ClientSession(connector=self._get_connector(), connector_owner=False, **kwargs)
+
+    async def get(self, user: dict) -> RESTClient:
+        """Get a connected client for the user, logging in only when there is no valid access token"""
+        key = self._key(user)
+        entry = self._entries.get(key)
+        if entry is None:
+            client_config: MyAirConfig = MyAirConfig(
+                username=user["username"],
+                password=user["password"],
+                region=user["region"],
+                device_token=user["device_token"],
+            )
+            entry = CachedClient(user, RESTClient(config=client_config, session=self._create_clientsession()))
+            entry.client.on_state_change = functools.partial(self.credentials.save, user)
+            self._entries[key] = entry
+
+        if not entry.client.is_access_token_valid():
+            async with entry.lock:
+                # a session stored by an earlier run or another replica saves the login entirely
+                await self._adopt_stored_session(entry)
+                # connect() re-checks the token, so waiting on a background refresh does not log in twice
+                await entry.client.connect()
+            self._schedule_refresh(key, entry)
+        return entry.client
+
+    async def _adopt_stored_session(self, entry: CachedClient) -> None:
+        """Resume the stored session when it outlives the client's own access token"""
+        state = await self.credentials.load(entry.user)
+        if state is not None and (state.get("access_token_expires_at") or 0) > (
+            entry.client.access_token_expires_at or 0
+        ):
+            entry.client.restore_state(state)
+
+    def _schedule_refresh(self, key: str, entry: CachedClient) -> None:
+        current = entry.refresh_task
+        if current is not None and not current.done() and current is not asyncio.current_task():
+            current.cancel()
+        delay = max(0.0, entry.client.access_token_expires_in() - self.refresh_ahead_seconds)
+        entry.refresh_task = asyncio.create_task(self._refresh(key, entry, delay))
+
+    async def _refresh(self, key: str, entry: CachedClient, delay: float) -> None:
+        """Re-authenticate ahead of the access token expiry"""
+        _method = f"{self._module}.{self._class}._refresh"
+        await asyncio.sleep(delay)
+        try:
+            async with entry.lock:
+                # another replica may have refreshed the shared session already
+                await self._adopt_stored_session(entry)
+                if entry.client.access_token_expires_in() <= self.refresh_ahead_seconds:
+                    await entry.client.reauthenticate()
+            self.log.debug(_method, "Refreshed access token ahead of expiry")
+        except Exception as ex:
+            # leave the entry in place, the next poll will log in again once the token is no longer valid
+            self.log.warn(_method, f"Failed to refresh access token: {ex}", traceback.format_exc())
+            return
+        if self._entries.get(key) is entry:
+            self._schedule_refresh(key, entry)
+
+    async def evict(self, user: dict) -> None:
+        """Drop the cached client for the user, so the next poll starts from a fresh login"""
+        entry = self._entries.pop(self._key(user), None)
+        if entry is not None:
+            await self._close_entry(entry)
+
+    async def _close_entry(self, entry: CachedClient) -> None:
+        if entry.refresh_task is not None and not entry.refresh_task.done():
+            entry.refresh_task.cancel()
+        await entry.client.close()
+
+    async def close(self) -> None:
+        """Close every cached client, its session and the shared connection pool"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            await self._close_entry(entry)
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
@@ -0,0 +1,270 @@
+import calendar
+import dataclasses
+import datetime
+import typing
+
+from prometheus_client import Counter, Gauge
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+NAMESPACE = "myair"
+
+NIGHT_LABELS = ["patient", "device", "date", "mask"]
+# the night metrics without a date label, used by the timestamps exposition
+LATEST_LABELS = ["patient", "device", "mask"]
+
+SERIES = Gauge(
+    namespace=NAMESPACE, subsystem="exporter", name="series", documentation="Number of myAir series currently exported"
+)
+
+SERIES_EVICTIONS = Counter(
+    namespace=NAMESPACE,
+    subsystem="exporter",
+    name="series_evictions",
+    documentation="Number of myAir series evicted, because their night left the records window or over the series budget",
+    labelnames=["reason"],
+)
+
+# name and documentation of every per night metric, Night.values follows this order
+NIGHT_METRICS: typing.List[typing.Tuple[str, str]] = [
+    (
+        "score",
+        "myAir calculates your score by analyzing your nightly therapy data. The higher your score, the better. You get points based on the following four key categories: usage, mask seal, events, and mask on/off. The maximum score you can get is 100 points.",
+    ),
+    ("usage_seconds", "The MyAir usage time in seconds"),
+    (
+        "usage_score",
+        "The point system for usage is calculated in hours and minutes. If you use your therapy for 1 hour you get 10 points, or for 2.3 hours (2 hours, 18 minutes) you get 23 points. The more time you use your therapy, the more points you receive, up to a maximum of 70 points.",
+    ),
+    (
+        "mask_seal",
+        "The better your mask seal, the more points you get. This category can help you know if you need to adjust or change your mask to get a better fit. If your mask seal is poor, it can affect your comfort and the quality of your treatment. Your score reduces as your mask leak increases. You can get up to 20 points for minimal mask leak, 10 to 15 points for moderate leak, and 0 to 10 points for higher leak.",
+    ),
+    (
+        "mask_seal_score",
+        "Your score reduces as your mask leak increases. You can get up to 20 points for minimal mask leak, 10 to 15 points for moderate leak, and 0 to 10 points for higher leak.",
+    ),
+    (
+        "mask_onoff_count",
+        "The MyAir mask on/off status. The fewer times you take your mask on and off throughout the night, the more points you get. Everyone has to take their mask on and off one time during treatment. So, for example, if you remove your mask one or two times, you get 5 points. However, if you take your mask on and off several times, it can indicate a problem with mask fit or with your sleep in general.",
+    ),
+    (
+        "mask_onoff_score",
+        "The MyAir mask on/off score. The fewer times you take your mask on and off throughout the night, the more points you get. 1-2: 5 points, 3: 4 points, 4: 3 points, 5: 2 points, 6 or more: 0 points.",
+    ),
+    (
+        "ahi",
+        "Your CPAP machine notes the number of breathing events you have in each hour. This number can help measure how well your treatment is working. When you have an apnea, air stops flowing to your lungs for 10 seconds or longer -- that is, you actually stop breathing.",
+    ),
+    (
+        "ahi_score",
+        "The fewer breathing events you have each hour, the more points you get. These breathing events are also known as the apnea-hypopnea index (or AHI). myAir measures how many times your breathing partially or fully stops each hour. If you have minimal events, you get 4 to 5 points.",
+    ),
+]
+
+
+class Night(typing.NamedTuple):
+    device: str
+    mask: str
+    # one value per entry of NIGHT_METRICS
+    values: typing.Tuple[float, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class PatientSnapshot:
+    """Everything exported for one patient, built once per fetch and never mutated afterwards"""
+
+    patientId: str
+    # id, name, ahi
+    patient: typing.Tuple[str, str, str]
+    # (serialNumber, manufacturer, type, name, image, lastReportDate, patient), active
+    devices: typing.List[typing.Tuple[typing.Tuple[str, ...], float]]
+    # (patient, code, name, type, image), active
+    masks: typing.List[typing.Tuple[typing.Tuple[str, ...], float]]
+    # keyed by the night's startDate
+    nights: typing.Dict[str, Night]
+    # (patient, device, mask, lastReportDate), total days
+    total_days: typing.Tuple[typing.Tuple[str, ...], float]
+    total_usage_seconds: float
+
+
+class MyAirCollector(Collector):
+    """Renders the myAir metric families at scrape time from the latest snapshot of every patient"""
+
+    def __init__(self, records_days: int, max_series: int, exposition: str = "labels") -> None:
+        self.records_days = records_days
+        self.max_series = max_series
+        # labels: one series per night, keyed by a date label
+        # timestamps: one series per patient carrying the latest night at its startDate, plus *_latest gauges
+        self.timestamps = exposition.lower() == "timestamps"
+        self._snapshots: typing.Dict[str, PatientSnapshot] = {}
+        # bumped on every published snapshot, lets the exposition cache know when to render again
+        self.version = 0
+        # called with every published snapshot, a worker process forwards them to the parent's collector
+        self.on_update: typing.Optional[typing.Callable[[PatientSnapshot], None]] = None
+        # the records window cutoff the snapshots were last evicted against
+        self._cutoff: typing.Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config) -> "MyAirCollector":
+        return cls(
+            records_days=config.settings.myair["records_days"] or 90,
+            max_series=config.settings.myair["max_series"],
+            exposition=config.metrics["exposition"],
+        )
+
+    def get(self, patientId: str) -> typing.Optional[PatientSnapshot]:
+        return self._snapshots.get(patientId)
+
+    def update(self, snapshot: PatientSnapshot) -> None:
+        """Publish a patient's snapshot, swapping the whole mapping so a scrape never sees a half-written one"""
+        snapshots = dict(self._snapshots)
+        snapshots[snapshot.patientId] = snapshot
+        self._snapshots = self._evict(snapshots)
+        self.version += 1
+        if self.on_update is not None:
+            self.on_update(self._snapshots[snapshot.patientId])
+
+    def expire(self) -> None:
+        """Evict the nights that left the records window since the last update, a patient may not change for days"""
+        if self._cutoff == self._window_cutoff():
+            return
+        self._snapshots = self._evict(dict(self._snapshots))
+        self.version += 1
+
+    def _window_cutoff(self) -> str:
+        return (datetime.date.today() - datetime.timedelta(days=self.records_days)).strftime("%Y-%m-%d")
+
+    def _night_series(self, nights: int) -> int:
+        if self.timestamps:
+            # the timestamped and the *_latest family of every night metric, whatever the number of nights
+            return 2 * len(NIGHT_METRICS) if nights else 0
+        return nights * len(NIGHT_METRICS)
+
+    def _series_count(self, snapshot: PatientSnapshot, nights: int) -> int:
+        # patient, total days and total usage, plus the device, mask and night series
+        return 3 + len(snapshot.devices) + len(snapshot.masks) + self._night_series(nights)
+
+    def _published(self, patientId: str) -> typing.Dict[str, Night]:
+        # the nights currently exposed for the patient, evictions are counted against them
+        snapshot = self._snapshots.get(patientId)
+        return snapshot.nights if snapshot is not None else {}
+
+    def _evict(self, snapshots: typing.Dict[str, PatientSnapshot]) -> typing.Dict[str, PatientSnapshot]:
+        """Drop nights outside the records window, then the oldest nights until the series budget is met"""
+        cutoff = self._window_cutoff()
+        self._cutoff = cutoff
+        nights: typing.Dict[str, typing.Dict[str, Night]] = {}
+        for patientId, snapshot in snapshots.items():
+            kept = {date: night for date, night in snapshot.nights.items() if date[:10] >= cutoff}
+            if len(kept) < len(snapshot.nights):
+                # a night only counts the first time it leaves, not each time a fetch brings it back
+                published = self._published(patientId)
+                dropped = sum(1 for date in snapshot.nights if date not in kept and date in published)
+                evicted = self._night_series(len(published)) - self._night_series(len(published) - dropped)
+                if evicted:
+                    SERIES_EVICTIONS.labels(reason="window").inc(evicted)
+                nights[patientId] = kept
+
+        series = sum(
+            self._series_count(snapshot, len(nights.get(patientId, snapshot.nights)))
+            for patientId, snapshot in snapshots.items()
+        )
+        # with timestamps the night series do not grow with the number of nights, so there is nothing to trade
+        if series > self.max_series and not self.timestamps:
+            # oldest nights first, whichever patient they belong to
+            candidates = sorted(
+                (date, patientId)
+                for patientId, snapshot in snapshots.items()
+                for date in nights.get(patientId, snapshot.nights)
+            )
+            for date, patientId in candidates:
+                if series <= self.max_series:
+                    break
+                kept = nights.setdefault(patientId, dict(snapshots[patientId].nights))
+                del kept[date]
+                series -= len(NIGHT_METRICS)
+                if date in self._published(patientId):
+                    SERIES_EVICTIONS.labels(reason="budget").inc(len(NIGHT_METRICS))
+
+        for patientId, kept in nights.items():
+            snapshots[patientId] = dataclasses.replace(snapshots[patientId], nights=kept)
+        SERIES.set(series)
+        return snapshots
+
+    @staticmethod
+    def _night_timestamp(date: str) -> float:
+        return calendar.timegm(datetime.date.fromisoformat(date[:10]).timetuple())
+
+    def collect(self) -> typing.Iterable[GaugeMetricFamily]:
+        snapshots = list(self._snapshots.values())
+
+        patient = GaugeMetricFamily(
+            f"{NAMESPACE}_patient",
+            "A reference metric for the patient to be used in other metrics",
+            labels=["id", "name", "ahi"],
+        )
+        device = GaugeMetricFamily(
+            f"{NAMESPACE}_device",
+            "A reference metric for the device to be used in other metrics",
+            labels=["serialNumber", "manufacturer", "type", "name", "image", "lastReportDate", "patient"],
+        )
+        mask = GaugeMetricFamily(
+            f"{NAMESPACE}_mask",
+            "A reference metric for the mask to be used in other metrics",
+            labels=["patient", "code", "name", "type", "image"],
+        )
+        night_labels = LATEST_LABELS if self.timestamps else NIGHT_LABELS
+        nights = [
+            GaugeMetricFamily(f"{NAMESPACE}_{name}", documentation, labels=night_labels)
+            for name, documentation in NIGHT_METRICS
+        ]
+        latest = (
+            [
+                GaugeMetricFamily(
+                    f"{NAMESPACE}_{name}_latest", f"{documentation} Value of the latest night.", labels=LATEST_LABELS
+                )
+                for name, documentation in NIGHT_METRICS
+            ]
+            if self.timestamps
+            else []
+        )
+        total_days_count = GaugeMetricFamily(
+            f"{NAMESPACE}_total_days_count",
+            "Total number of days the user has been using any device.",
+            labels=["patient", "device", "mask", "lastReportDate"],
+        )
+        total_usage_seconds = GaugeMetricFamily(
+            f"{NAMESPACE}_total_usage_seconds", "Total usage time of any device in seconds.", labels=["patient"]
+        )
+
+        for snapshot in snapshots:
+            patient.add_metric(list(snapshot.patient), 1)
+            for labels, active in snapshot.devices:
+                device.add_metric(list(labels), active)
+            for labels, active in snapshot.masks:
+                mask.add_metric(list(labels), active)
+            if self.timestamps:
+                if snapshot.nights:
+                    date = max(snapshot.nights)
+                    night = snapshot.nights[date]
+                    labels = [snapshot.patientId, night.device, night.mask]
+                    timestamp = self._night_timestamp(date)
+                    for family, latest_family, value in zip(nights, latest, night.values):
+                        family.add_metric(labels, value, timestamp=timestamp)
+                        latest_family.add_metric(labels, value)
+            else:
+                for date, night in snapshot.nights.items():
+                    labels = [snapshot.patientId, night.device, date, night.mask]
+                    for family, value in zip(nights, night.values):
+                        family.add_metric(labels, value)
+            total_days_count.add_metric(list(snapshot.total_days[0]), snapshot.total_days[1])
+            total_usage_seconds.add_metric([snapshot.patientId], snapshot.total_usage_seconds)
+
+        yield patient
+        yield device
+        yield mask
+        yield from nights
+        yield from latest
+        yield total_days_count
+        yield total_usage_seconds
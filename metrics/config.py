@@ -1,5 +1,4 @@
 import codecs
-import inspect
 import os
 import traceback
 
@@ -12,9 +11,9 @@ from libs.settings import Settings
 
 class MyAirMetricsConfig:
     def __init__(self, file: str):
-        _method = inspect.stack()[0][3]
         self._class = self.__class__.__name__
         self._module = os.path.basename(__file__)[:-3]
+        _method = f"{self._module}.{self._class}.__init__"
         self.settings = Settings()
         log_level = LogLevel[self.settings.log_level.upper()]
         if not log_level:
@@ -25,15 +24,23 @@ class MyAirMetricsConfig:
         self.metrics = {
             "port": int(utils.dict_get(os.environ, "MAE_CONFIG_METRICS_PORT", "8933")),
             "pollingInterval": int(utils.dict_get(os.environ, "MAE_CONFIG_METRICS_POLLING_INTERVAL", "60")),
+            # worker processes polling a partition of the users each, 1 polls every user in this process
+            "workers": max(1, int(utils.dict_get(os.environ, "MAE_CONFIG_METRICS_WORKERS", "1"))),
+            # seconds the exporter's own metrics are served before they are rendered again, the myAir series on new data
+            "cacheMaxAge": float(utils.dict_get(os.environ, "MAE_CONFIG_METRICS_CACHE_MAX_AGE", "15")),
+            # labels: a date label per night, timestamps: the latest night at its startDate plus *_latest gauges
+            "exposition": utils.dict_get(os.environ, "MAE_CONFIG_METRICS_EXPOSITION", "labels"),
         }
 
         # load config from file
         try:
             # check if file exists
             if os.path.exists(file):
-                self.log.debug(f"{self._module}.{self._class}.{_method}", f"Loading config from {file}")
+                self.log.debug(_method, f"Loading config from {file}")
                 with codecs.open(file, encoding="utf-8-sig", mode="r") as f:
-                    settings = yaml.safe_load(f)
+                    settings = yaml.safe_load(f) or {}
+                    # the file's metrics only override the keys it sets, the others keep their defaults
+                    self.metrics.update(settings.pop("metrics", None) or {})
                     self.__dict__.update(settings)
         except yaml.YAMLError as exc:
-            self.log.error(f"{self._module}.{self._class}.{_method}", str(exc), traceback.format_exc())
+            self.log.error(_method, str(exc), traceback.format_exc())
@@ -0,0 +1,124 @@
+import json
+import os
+import traceback
+import typing
+
+from libs import settings, utils
+from libs.enums.loglevel import LogLevel
+from libs.logger import Log
+from libs.mongodb.MyAirCredentialsDatabase import MyAirCredentialsDatabase
+from libs.tracing import current_span, traced
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None  # type: ignore
+    InvalidToken = Exception  # type: ignore
+
+
+class CredentialStore:
+    """Keeps each user's Okta session encrypted in MongoDB, with a file copy, so restarts and replicas reuse it"""
+
+    def __init__(self) -> None:
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        _method = f"{self._module}.{self._class}.__init__"
+
+        self.settings = settings.Settings()
+        log_level = LogLevel[self.settings.log_level.upper()]
+        if not log_level:
+            log_level = LogLevel.DEBUG
+        self.log = Log(minimumLogLevel=log_level)
+
+        self.credentials_db = MyAirCredentialsDatabase()
+        self.path = self.settings.credentials["path"]
+        # the stored version of each key this process last read or wrote, for optimistic concurrency
+        self._versions: typing.Dict[str, typing.Optional[int]] = {}
+
+        self._fernet = None
+        key = self.settings.credentials["key"]
+        if not key:
+            self.log.info(_method, "MAE_CREDENTIALS_KEY is not set, sessions are not persisted")
+        elif Fernet is None:
+            self.log.warn(_method, "The cryptography package is not installed, sessions are not persisted")
+        else:
+            self._fernet = Fernet(key.encode("utf-8"))
+
+    @property
+    def enabled(self) -> bool:
+        return self._fernet is not None
+
+    @staticmethod
+    def _key(user: dict) -> str:
+        # the account name is only ever stored hashed
+        return utils.user_hash(user)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    @traced
+    async def load(self, user: dict) -> typing.Optional[dict]:
+        """The user's stored session state, from MongoDB or else the file copy, None if there is none usable"""
+        _method = current_span()
+        if not self.enabled:
+            return None
+        key = self._key(user)
+        stored = await self.credentials_db.get(key)
+        # only a MongoDB document's version can match the next write, a session read from the file is inserted anew
+        self._versions[key] = stored.get("version") if stored is not None else None
+        if stored is None:
+            stored = self._read_file(key)
+        if stored is None:
+            return None
+        try:
+            return json.loads(self._fernet.decrypt(stored["payload"].encode("utf-8")))  # type: ignore
+        except InvalidToken:
+            # encrypted with another key, the next token exchange overwrites it
+            self.log.warn(_method, "Unable to decrypt the stored session, ignoring it")
+            return None
+
+    @traced
+    async def save(self, user: dict, state: dict) -> None:
+        """Store the user's session state, keeping a session that another replica stored and that outlives it"""
+        _method = current_span()
+        if not self.enabled:
+            return
+        key = self._key(user)
+        payload = self._fernet.encrypt(json.dumps(state).encode("utf-8")).decode("utf-8")  # type: ignore
+
+        version = await self.credentials_db.save(key, payload, self._versions.get(key))
+        if version is None:
+            # someone else wrote since this process last read, only overwrite a session that expires sooner
+            stored = await self.load(user)
+            if stored is not None and (stored.get("access_token_expires_at") or 0) >= (
+                state.get("access_token_expires_at") or 0
+            ):
+                self.log.debug(_method, "A newer session is already stored")
+                return
+            version = await self.credentials_db.save(key, payload, self._versions.get(key))
+        if version is not None:
+            self._versions[key] = version
+        self._write_file(key, {"key": key, "version": version, "payload": payload})
+
+    def _read_file(self, key: str) -> typing.Optional[dict]:
+        _method = f"{self._module}.{self._class}._read_file"
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            self.log.warn(_method, f"Unable to read {self._file(key)}: {ex}", traceback.format_exc())
+            return None
+
+    def _write_file(self, key: str, stored: dict) -> None:
+        _method = f"{self._module}.{self._class}._write_file"
+        try:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            temp = f"{self._file(key)}.tmp"
+            # written aside and renamed, a crash never leaves a half written file behind
+            with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+                json.dump(stored, f)
+            os.replace(temp, self._file(key))
+        except Exception as ex:
+            self.log.warn(_method, f"Unable to write {self._file(key)}: {ex}", traceback.format_exc())
@@ -0,0 +1,21 @@
+import time
+import typing
+
+
+class EntityCache:
+    """Keeps the slowly changing entities of each user in memory, each kind refreshed on its own TTL"""
+
+    def __init__(self, ttls: typing.Mapping[str, float]) -> None:
+        # seconds an entity kind is served from memory before it is fetched again, e.g. {"patient": 86400}
+        self.ttls = ttls
+        self._entries: typing.Dict[typing.Tuple[str, str], typing.Tuple[typing.Any, float]] = {}
+
+    def get(self, key: str, kind: str) -> typing.Optional[typing.Any]:
+        """The cached entity, or None when it was never fetched or its TTL expired"""
+        entry = self._entries.get((key, kind))
+        if entry is None or time.monotonic() - entry[1] >= self.ttls.get(kind, 0):
+            return None
+        return entry[0]
+
+    def put(self, key: str, kind: str, value: typing.Any) -> None:
+        self._entries[(key, kind)] = (value, time.monotonic())
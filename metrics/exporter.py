@@ -1,38 +1,106 @@
-import inspect
+import asyncio
 import os
 import traceback
+import typing
 
 from libs.enums.loglevel import LogLevel
 from libs.logger import Log
+from libs.logsink import LogSink
+from libs.mongodb.MongoClientSingleton import MongoClientSingleton
+from libs.mongodb.MyAirLogsDatabase import MyAirLogsDatabase
 from libs.settings import Settings
+from metrics.collector import MyAirCollector
 from metrics.config import MyAirMetricsConfig
+from metrics.exposition import ExpositionCache
 from metrics.myair import MyAirMetrics
-from prometheus_client import start_http_server
+from metrics.server import MetricsServer
+from metrics.workers import WorkerMetricsCollector, WorkerPool
+from prometheus_client import REGISTRY
+from prometheus_client.registry import CollectorRegistry
 
 
 class MetricsExporter:
     def __init__(self):
-        _method = inspect.stack()[0][3]
         self._class = self.__class__.__name__
         self._module = os.path.basename(__file__)[:-3]
+        _method = f"{self._module}.{self._class}.__init__"
         self.settings = Settings()
         log_level = LogLevel[self.settings.log_level.upper()]
         if not log_level:
             log_level = LogLevel.DEBUG
         self.log = Log(log_level)
+        # process exit status: non-zero when the exporter failed or could not shut down cleanly
+        self.exit_code = 0
 
-        self.log.debug(f"{self._module}.{self._class}.{_method}", "Exporter initialized")
+        self.log.debug(_method, "Exporter initialized")
 
     async def run(self):
-        _method = inspect.stack()[1][3]
+        _method = f"{self._module}.{self._class}.run"
+        server = None
+        app_metrics = None
+        pool = None
         try:
+            # database log writes are batched from a background task from here on
+            LogSink.get_instance().start(MyAirLogsDatabase().insert_logs)
             config = MyAirMetricsConfig("metrics/config.yml")
-            app_metrics = MyAirMetrics(config)
-            start_http_server(config.metrics["port"])
-            self.log.info(
-                f"{self._module}.{self._class}.{_method}",
-                f"Exporter Starting Listen => :{config.metrics['port']}/metrics",
-            )
-            await app_metrics.run_metrics_loop()
+            # more workers than users would leave some of them with nothing to poll
+            workers = min(config.metrics["workers"], len(config.settings.myair["users"]))
+            if workers > 1:
+                # the users are polled by worker processes, this process only merges their snapshots and serves them
+                collector = MyAirCollector.from_config(config)
+                pool = WorkerPool(workers, collector)
+                # this process does no polling, its registry is merged with the metrics the workers forward
+                registry = CollectorRegistry(auto_describe=False)
+                registry.register(WorkerMetricsCollector(REGISTRY, pool))
+                cache = ExpositionCache(registry, collector, max_age=config.metrics["cacheMaxAge"])
+                server = MetricsServer(config.metrics["port"], cache, pool)
+                await server.start()
+                await pool.run()
+            else:
+                app_metrics = MyAirMetrics(config)
+                cache = ExpositionCache(REGISTRY, app_metrics.collector, max_age=config.metrics["cacheMaxAge"])
+                server = MetricsServer(config.metrics["port"], cache, app_metrics)
+                # serving first, probes get an answer while an unreachable MongoDB times the bootstrap out
+                await server.start()
+                await app_metrics.ensure_schema()
+                await app_metrics.run_metrics_loop()
         except Exception as ex:
-            self.log.error(f"{self._module}.{self._class}.{_method}", str(ex), traceback.format_exc())
+            self.exit_code = 1
+            self.log.error(_method, str(ex), traceback.format_exc())
+        finally:
+            # also runs when a signal cancels the exporter, a cancelled poll never gets to write anything half way
+            if not await self.shutdown(server, app_metrics, pool):
+                self.exit_code = 1
+
+    async def shutdown(
+        self,
+        server: typing.Optional[MetricsServer],
+        app_metrics: typing.Optional[MyAirMetrics],
+        pool: typing.Optional[WorkerPool] = None,
+    ) -> bool:
+        """Stop serving and the workers, close the clients, flush queued logs and close MongoDB within the timeout"""
+        _method = f"{self._module}.{self._class}.shutdown"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.settings.shutdown_timeout
+        clean = True
+
+        steps: typing.List[typing.Tuple[str, typing.Callable[[], typing.Awaitable]]] = []
+        if server is not None:
+            steps.append(("server", server.stop))
+        if pool is not None:
+            steps.append(("workers", pool.stop))
+        if app_metrics is not None:
+            steps.append(("clients", app_metrics.close))
+        steps.append(("logs", lambda: LogSink.get_instance().stop(timeout=max(0.0, deadline - loop.time()))))
+        steps.append(("mongodb", MongoClientSingleton.close_client))
+
+        for name, step in steps:
+            try:
+                await asyncio.wait_for(step(), timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                clean = False
+                self.log.warn(_method, f"Timed out stopping {name}")
+            except Exception as ex:
+                clean = False
+                self.log.warn(_method, f"Failed to stop {name}: {ex}", traceback.format_exc())
+        return clean
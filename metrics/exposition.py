@@ -0,0 +1,75 @@
+import hashlib
+import time
+import typing
+import zlib
+
+from metrics.collector import MyAirCollector
+from prometheus_client import generate_latest
+from prometheus_client.registry import CollectorRegistry
+
+
+class RenderedExposition(typing.NamedTuple):
+    body: bytes
+    gzip_body: bytes
+    # one per representation, the identity and the gzip body are different bytes
+    etag: str
+    gzip_etag: str
+    rendered_at: float
+    version: int
+
+
+class ExpositionCache:
+    """Renders the myAir series once per data change and the exporter's own metrics at most every max_age"""
+
+    def __init__(self, registry: CollectorRegistry, collector: MyAirCollector, max_age: float) -> None:
+        # the exporter's own metrics (spans, evictions, ...), small whatever the number of nights
+        self.registry = registry
+        self.collector = collector
+        # the exporter's own metrics move between polls, so re-render them at least this often
+        self.max_age = max_age
+        self._collector_registry = CollectorRegistry(auto_describe=False)
+        self._collector_registry.register(collector)
+        # the collector's text, its compressed prefix and digest, for the collector version they were rendered at
+        self._collector_version: typing.Optional[int] = None
+        self._collector_body = b""
+        self._collector_gzip = b""
+        self._compressor: typing.Optional[typing.Any] = None
+        self._collector_digest = b""
+        self._rendered: typing.Optional[RenderedExposition] = None
+
+    def _is_fresh(self, rendered: typing.Optional[RenderedExposition]) -> bool:
+        return (
+            rendered is not None
+            and rendered.version == self.collector.version
+            and time.monotonic() - rendered.rendered_at < self.max_age
+        )
+
+    def get(self) -> RenderedExposition:
+        """The cached exposition, the myAir series rendered again only when the data changed"""
+        # the records window moves daily even when no patient changes
+        self.collector.expire()
+        if self._is_fresh(self._rendered):
+            return self._rendered  # type: ignore
+        version = self.collector.version
+        if version != self._collector_version:
+            self._collector_body = generate_latest(self._collector_registry)
+            # one gzip stream flushed after the collector's text, each render only compresses its own metrics onto a copy
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            self._collector_gzip = self._compressor.compress(self._collector_body) + self._compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+            self._collector_digest = hashlib.blake2b(self._collector_body, digest_size=16).digest()
+            self._collector_version = version
+
+        own = generate_latest(self.registry)
+        compressor = self._compressor.copy()  # type: ignore
+        digest = hashlib.blake2b(self._collector_digest + own, digest_size=16).hexdigest()
+        self._rendered = RenderedExposition(
+            body=self._collector_body + own,
+            gzip_body=self._collector_gzip + compressor.compress(own) + compressor.flush(),
+            etag=f'"{digest}"',
+            gzip_etag=f'"{digest}-gzip"',
+            rendered_at=time.monotonic(),
+            version=version,
+        )
+        return self._rendered
@@ -1,32 +1,48 @@
 import asyncio
 import datetime
-import inspect
 import math
 import os
+import time
 import traceback
+import typing
 
-import aiohttp
-from libs import settings
+from libs import settings, utils
 from libs.enums.loglevel import LogLevel
 from libs.logger import Log
 from libs.models.Mask import Mask
 from libs.models.Patient import Patient
 from libs.models.SleepDevice import SleepDevice
 from libs.models.SleepRecord import SleepRecord
+from libs.models.SleepSummary import SleepSummary
 from libs.mongodb.MyAirDevicesDatabase import MyAirDevicesDatabase
 from libs.mongodb.MyAirMasksDatabase import MyAirMasksDatabase
 from libs.mongodb.MyAirPatientsDatabase import MyAirPatientsDatabase
+from libs.mongodb.MyAirSleepRecordMonthsDatabase import MyAirSleepRecordMonthsDatabase
 from libs.mongodb.MyAirSleepRecordsDatabase import MyAirSleepRecordsDatabase
-from libs.resmed.client.myair_client import MyAirConfig
 from libs.resmed.client.rest_client import RESTClient
-from prometheus_client import Gauge
+from libs.tracing import current_span, traced
+from metrics.clients import MyAirClientCache
+from metrics.collector import MyAirCollector, Night, PatientSnapshot
+from metrics.entities import EntityCache
+from metrics.scheduler import PollScheduler
+from prometheus_client import Counter
+
+T = typing.TypeVar("T")
+
+PROBES = Counter(
+    namespace="myair",
+    subsystem="exporter",
+    name="probes",
+    documentation="Number of device-only probes by result: unchanged skips the full fetch, changed does not",
+    labelnames=["result"],
+)
 
 
 class MyAirMetrics:
     def __init__(self, config):
-        _method = inspect.stack()[0][3]
         self._module = os.path.basename(__file__)[:-3]
         self._class = self.__class__.__name__
+        _method = f"{self._module}.{self._class}.__init__"
 
         self.namespace = "myair"
         self.polling_interval_seconds = config.metrics["pollingInterval"]
@@ -43,296 +59,470 @@ class MyAirMetrics:
         self.masks_db = MyAirMasksDatabase()
         self.patient_db = MyAirPatientsDatabase()
         self.device_db = MyAirDevicesDatabase()
-
-        self.patient = Gauge(
-            namespace=self.namespace,
-            name="patient",
-            documentation="A reference metric for the patient to be used in other metrics",
-            labelnames=["id", "name", "ahi"],
-        )
-
-        self.device = Gauge(
-            namespace=self.namespace,
-            name="device",
-            documentation="A reference metric for the device to be used in other metrics",
-            labelnames=["serialNumber", "manufacturer", "type", "name", "image", "lastReportDate", "patient"],
-        )
-
-        self.mask = Gauge(
-            namespace=self.namespace,
-            name="mask",
-            documentation="A reference metric for the mask to be used in other metrics",
-            labelnames=["patient", "code", "name", "type", "image"],
-        )
-
-        self.score = Gauge(
-            namespace=self.namespace,
-            name="score",
-            documentation="myAir calculates your score by analyzing your nightly therapy data. The higher your score, the better. You get points based on the following four key categories: usage, mask seal, events, and mask on/off. The maximum score you can get is 100 points.",
-            labelnames=["patient", "device", "date", "mask"],
+        self.sleep_record_months_db = MyAirSleepRecordMonthsDatabase()
+
+        # per user incremental sync state: the patient id and the time of the last full reconciliation
+        self._sync_state: typing.Dict[str, dict] = {}
+        # per user content fingerprints of the last responses: device, patient and mask with their models, and records
+        self._fingerprints: typing.Dict[str, dict] = {}
+        # unix time the last poll cycle completed, None until the first one did
+        self.last_fetch: typing.Optional[float] = None
+
+        # per user next-due times, fast around the expected upload and backing off in between
+        self.scheduler = PollScheduler(
+            min_interval=self.polling_interval_seconds,
+            max_interval=self.settings.myair["poll_max_interval"],
+            upload_window=self.settings.myair["upload_window"],
+            jitter=self.settings.myair["poll_jitter"],
         )
 
-        self.usage = Gauge(
-            namespace=self.namespace,
-            name="usage_seconds",
-            documentation="The MyAir usage time in seconds",
-            labelnames=["patient", "device", "date", "mask"],
+        # patient, mask and device catalog, refreshed on their own TTLs rather than every poll
+        self.entities = EntityCache(
+            ttls={
+                "patient": self.settings.myair["patient_ttl"],
+                "mask": self.settings.myair["mask_ttl"],
+                "masks": self.settings.myair["mask_ttl"],
+                "devices": self.settings.myair["device_ttl"],
+            }
         )
 
-        self.usage_score = Gauge(
-            namespace=self.namespace,
-            name="usage_score",
-            documentation="The point system for usage is calculated in hours and minutes. If you use your therapy for 1 hour you get 10 points, or for 2.3 hours (2 hours, 18 minutes) you get 23 points. The more time you use your therapy, the more points you receive, up to a maximum of 70 points.",
-            labelnames=["patient", "device", "date", "mask"],
-        )
-
-        self.mask_seal = Gauge(
-            namespace=self.namespace,
-            name="mask_seal",
-            documentation="The better your mask seal, the more points you get. This category can help you know if you need to adjust or change your mask to get a better fit. If your mask seal is poor, it can affect your comfort and the quality of your treatment. Your score reduces as your mask leak increases. You can get up to 20 points for minimal mask leak, 10 to 15 points for moderate leak, and 0 to 10 points for higher leak.",
-            labelnames=["patient", "device", "date", "mask"],
-        )
+        self.clients = MyAirClientCache(refresh_ahead_seconds=self.settings.myair["token_refresh_ahead"])
 
-        self.mask_seal_score = Gauge(
-            namespace=self.namespace,
-            name="mask_seal_score",
-            documentation="Your score reduces as your mask leak increases. You can get up to 20 points for minimal mask leak, 10 to 15 points for moderate leak, and 0 to 10 points for higher leak.",
-            labelnames=["patient", "device", "date", "mask"],
-        )
+        # rendered from the latest per patient snapshot, by the exposition cache once per data change
+        self.collector = MyAirCollector.from_config(config)
 
-        self.mask_onoff_count = Gauge(
-            namespace=self.namespace,
-            name="mask_onoff_count",
-            documentation="The MyAir mask on/off status. The fewer times you take your mask on and off throughout the night, the more points you get. Everyone has to take their mask on and off one time during treatment. So, for example, if you remove your mask one or two times, you get 5 points. However, if you take your mask on and off several times, it can indicate a problem with mask fit or with your sleep in general.",
-            labelnames=["patient", "device", "date", "mask"],
-        )
+        self.log.debug(_method, "Metrics initialized")
 
-        self.mask_onoff_score = Gauge(
-            namespace=self.namespace,
-            name="mask_onoff_score",
-            documentation="The MyAir mask on/off score. The fewer times you take your mask on and off throughout the night, the more points you get. 1-2: 5 points, 3: 4 points, 4: 3 points, 5: 2 points, 6 or more: 0 points.",
-            labelnames=["patient", "device", "date", "mask"],
+    async def run_metrics_loop(self, on_fetch: typing.Optional[typing.Callable[[float], None]] = None):
+        """Metrics fetching loop, polling each user when the scheduler says it is due"""
+        _method = f"{self._module}.{self._class}.run_metrics_loop"
+        users = self.config.settings.myair["users"]
+        if not users:
+            # nothing to poll, ready right away rather than waiting for a cycle that never comes
+            self.last_fetch = time.time()
+            if on_fetch is not None:
+                on_fetch(self.last_fetch)
+        while True:
+            try:
+                due = self.scheduler.due(users)
+                if due:
+                    self.log.debug(_method, f"Begin metrics fetch of {len(due)} users")
+                    await self.fetch(due)
+                    self.last_fetch = time.time()
+                    if on_fetch is not None:
+                        on_fetch(self.last_fetch)
+                    self.log.debug(_method, "End metrics fetch")
+            except Exception as ex:
+                self.log.error(_method, str(ex), traceback.format_exc())
+            delay = max(0.0, self.scheduler.next_due(users) - time.time())
+            self.log.debug(_method, f"Sleeping for {delay:.0f} seconds")
+            await asyncio.sleep(delay)
+
+    async def ensure_schema(self) -> bool:
+        """Create the indexes every repository relies on, run once at exporter startup"""
+        _method = f"{self._module}.{self._class}.ensure_schema"
+        created = await asyncio.gather(
+            *[
+                db.ensure_indexes()
+                for db in [
+                    self.sleep_records_db,
+                    self.sleep_record_months_db,
+                    self.masks_db,
+                    self.patient_db,
+                    self.device_db,
+                    self.clients.credentials.credentials_db,
+                ]
+            ]
         )
-
-        self.ahi = Gauge(
-            namespace=self.namespace,
-            name="ahi",
-            documentation="Your CPAP machine notes the number of breathing events you have in each hour. This number can help measure how well your treatment is working. When you have an apnea, air stops flowing to your lungs for 10 seconds or longer -- that is, you actually stop breathing.",
-            labelnames=["patient", "device", "date", "mask"],
+        if not all(created):
+            # polling works without them, only slower, they are created again at the next start
+            self.log.warn(_method, "Schema bootstrap incomplete, some indexes could not be created")
+            return False
+        self.log.debug(_method, "Schema bootstrap complete")
+        return True
+
+    async def close(self):
+        """Release the cached myAir clients and their sessions"""
+        await self.clients.close()
+
+    @traced
+    async def fetch(self, users: typing.Optional[typing.List[dict]] = None):
+        """Poll the users, every configured one by default, running at most max_concurrent_users pipelines at once"""
+        _method = current_span()
+        if users is None:
+            users = self.config.settings.myair['users']
+        semaphore = asyncio.Semaphore(self.config.settings.myair["max_concurrent_users"])
+
+        async def bounded_fetch(user):
+            async with semaphore:
+                return await self.fetch_user(user)
+
+        results = await asyncio.gather(*[bounded_fetch(user) for user in users], return_exceptions=True)
+        for user, result in zip(users, results):
+            if isinstance(result, BaseException):
+                self.scheduler.failed(user)
+                self.log.error(
+                    _method,
+                    f"Failed to fetch metrics for user {user['username']}: {result}",
+                    "".join(traceback.format_exception(result)),
+                )
+            else:
+                self.scheduler.completed(user, result)
+
+    def _get_sync_window(self, user, record_days: int) -> typing.Tuple[bool, typing.Optional[str]]:
+        """Return (full_sync, start_date): a full reconciliation of records_days, or the incremental window"""
+        state = self._sync_state.get(user["username"])
+        if state is None or time.time() - state["lastFullSync"] >= self.settings.myair["full_sync_interval"]:
+            return True, None
+
+        # the last report date of the previous poll's summary, no extra database round-trip needed
+        lastReportDate = state.get("lastReportDate")
+        if lastReportDate is None:
+            return True, None
+
+        # overlap the window a few days so late-arriving corrections are picked up
+        start = datetime.date.fromisoformat(lastReportDate[:10]) - datetime.timedelta(
+            days=self.settings.myair["records_overlap_days"]
         )
-
-        self.ahi_score = Gauge(
-            namespace=self.namespace,
-            name="ahi_score",
-            documentation="The fewer breathing events you have each hour, the more points you get. These breathing events are also known as the apnea-hypopnea index (or AHI). myAir measures how many times your breathing partially or fully stops each hour. If you have minimal events, you get 4 to 5 points.",
-            labelnames=["patient", "device", "date", "mask"],
+        if start <= datetime.date.today() - datetime.timedelta(days=record_days):
+            return True, None
+        return False, start.strftime("%Y-%m-%d")
+
+    def _can_probe(self, user, full_sync: bool) -> bool:
+        """Whether a device-only probe may stand in for the full fetch: a recent fetch to compare with exists"""
+        state = self._sync_state.get(user["username"])
+        if full_sync or state is None or "lastFetch" not in state:
+            return False
+        # fetch everything once in a while anyway, the patient and mask info change without a device upload
+        return time.time() - state["lastFetch"] < self.settings.myair["staleness_interval"]
+
+    def _split_months(self, window_start: datetime.date) -> typing.Tuple[typing.List[datetime.date], datetime.date]:
+        """Split the window into closed calendar months and the start date of the still open part"""
+        today = datetime.date.today()
+        # the current month is always open, the previous one stays open for the first few days after rollover
+        open_start = today.replace(day=1)
+        if today.day <= self.settings.myair["records_overlap_days"]:
+            open_start = (open_start - datetime.timedelta(days=1)).replace(day=1)
+
+        closed_months: typing.List[datetime.date] = []
+        month = window_start.replace(day=1)
+        while month < open_start:
+            closed_months.append(month)
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+        return closed_months, max(open_start, window_start)
+
+    @traced
+    async def _get_closed_month_records(
+        self, client: RESTClient, patientId: str, months: typing.List[datetime.date]
+    ) -> typing.List[typing.Mapping[str, typing.Any]]:
+        """Get the sleep records of closed months, from the month cache or, on first sight, concurrently from myAir"""
+        records: typing.List[typing.Mapping[str, typing.Any]] = []
+        missing: typing.List[datetime.date] = []
+        cached_months = await asyncio.gather(
+            *[self.sleep_record_months_db.get(patientId, month.strftime("%Y-%m")) for month in months]
         )
-
-        self.total_days_count = Gauge(
-            namespace=self.namespace,
-            name="total_days_count",
-            documentation="Total number of days the user has been using any device.",
-            labelnames=["patient", "device", "mask", "lastReportDate"],
+        for month, cached in zip(months, cached_months):
+            if cached is None:
+                missing.append(month)
+            else:
+                records.extend(cached)
+
+        fetched = await asyncio.gather(
+            *[
+                client.get_sleep_records(
+                    start_date=month.strftime("%Y-%m-%d"),
+                    end_date=(
+                        (month + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+                    ).strftime("%Y-%m-%d"),
+                )
+                for month in missing
+            ]
         )
-
-        self.total_usage_seconds = Gauge(
-            namespace=self.namespace,
-            name="total_usage_seconds",
-            documentation="Total usage time of any device in seconds.",
-            labelnames=["patient"],
+        for month, items in zip(missing, fetched):
+            # a closed month never changes again, so it is only ever downloaded once
+            await self.sleep_record_months_db.insert(patientId, month.strftime("%Y-%m"), items)
+            records.extend(items)
+        return records
+
+    @traced
+    async def fetch_user(self, user) -> typing.Optional[str]:
+        """Fetch and export the metrics for a single myAir user, returning the device's lastSleepDataReportTime"""
+        record_days = self.config.settings.myair["records_days"] or 90
+        months: int = math.ceil(record_days / 30)
+        full_sync, start_date = self._get_sync_window(user, record_days)
+        window_start = (
+            datetime.date.fromisoformat(start_date)
+            if start_date
+            else datetime.date.today() - datetime.timedelta(days=record_days)
         )
-
-        self.log.debug(f"{self._module}.{self._class}.{_method}", "Metrics initialized")
-
-    async def run_metrics_loop(self):
-        """Metrics fetching loop"""
-        _method = inspect.stack()[0][3]
-        while True:
-            try:
-                self.log.debug(f"{self._module}.{self._class}.{_method}", "Begin metrics fetch")
-                await self.fetch()
-                self.log.debug(f"{self._module}.{self._class}.{_method}", "End metrics fetch")
-                self.log.debug(
-                    f"{self._module}.{self._class}.{_method}", f"Sleeping for {self.polling_interval_seconds} seconds"
-                )
-                await asyncio.sleep(self.polling_interval_seconds)
-            except Exception as ex:
-                self.log.error(f"{self._module}.{self._class}.{_method}", str(ex), traceback.format_exc())
-
-    def _create_clientsession(self, **kwargs):
-        return aiohttp.ClientSession(**kwargs)
-
-    async def fetch(self):
-        for user in self.config.settings.myair['users']:
-            # _method = inspect.stack()[0][3]
-            client_config: MyAirConfig = MyAirConfig(
-                username=user["username"],
-                password=user["password"],
-                region=user["region"],
-                device_token=user["device_token"],
+        closed_months, open_start = self._split_months(window_start)
+        cutoff = (datetime.date.today() - datetime.timedelta(days=record_days)).strftime("%Y-%m-%d")
+        try:
+            # the cached client only logs in again when its access token is about to expire
+            client: RESTClient = await self.clients.get(user)
+
+            if self._can_probe(user, full_sync):
+                # a small device-only query first, the rest is only fetched once the device uploaded again
+                probe = SleepDevice.from_map(await client.get_user_device_data())
+                if probe.lastSleepDataReportTime == self._sync_state[user["username"]]["lastSleepDataReportTime"]:
+                    PROBES.labels(result="unchanged").inc()
+                    return probe.lastSleepDataReportTime
+                PROBES.labels(result="changed").inc()
+
+            # patient and mask info rarely change, they are only part of the query once their TTL expired
+            cached_user_info: typing.Optional[Patient] = self.entities.get(user["username"], "patient")
+            cached_mask_info: typing.Optional[Mask] = self.entities.get(user["username"], "mask")
+
+            # device, patient, mask and the open months' sleep records all come back from a single GraphQL round-trip
+            patient_data = await client.get_patient_data(
+                months=months,
+                start_date=open_start.strftime("%Y-%m-%d"),
+                include_user=cached_user_info is None,
+                include_mask=cached_mask_info is None,
+            )
+            fingerprints = self._fingerprints.setdefault(user["username"], {"records": {}})
+            # unchanged responses reuse the models built from them last time and are not written again
+            user_device_data, device_changed = self._fingerprinted(
+                fingerprints, "device", patient_data.device, SleepDevice
+            )
+            user_info, user_changed = (
+                (cached_user_info, False)
+                if cached_user_info is not None
+                else self._fingerprinted(fingerprints, "patient", patient_data.user, Patient)
+            )
+            mask_info, mask_changed = (
+                (cached_mask_info, False)
+                if cached_mask_info is not None
+                else self._fingerprinted(fingerprints, "mask", patient_data.mask, Mask)
             )
-            client: RESTClient = RESTClient(config=client_config, session=self._create_clientsession())
-
-            await client.connect()
 
-            user_device_data = SleepDevice.from_map(await client.get_user_device_data())
-            record_days = self.config.settings.myair["records_days"] or 90
-            months: int = math.ceil(record_days / 30)
-            sleep_records = [SleepRecord.from_map(record) for record in await client.get_sleep_records(months=months)]
-            user_info = Patient.from_map(await client.get_user_info())
-            mask_info = Mask.from_map(await client.get_mask_info())
+            closed_records = await self._get_closed_month_records(client, user_info.id, closed_months)
+            # key by night, the open months' data wins if a night shows up in both
+            raw_records = {record["startDate"]: record for record in closed_records}
+            raw_records.update({record["startDate"]: record for record in patient_data.sleep_records})
+            # whole closed months reach back past the records window, nights outside it are neither stored nor exported
+            raw_records = {date: record for date, record in raw_records.items() if date[:10] >= cutoff}
+            # only nights whose item changed since it was last stored are rebuilt, written and exported again
+            record_fingerprints = {date: utils.fingerprint(record) for date, record in raw_records.items()}
+            changed_dates = [
+                date for date, value in record_fingerprints.items() if fingerprints["records"].get(date) != value
+            ]
+            sleep_records = [SleepRecord.from_map(raw_records[date]) for date in changed_dates]
+            unchanged_dates = set(raw_records) - set(changed_dates)
 
             # print(f"user_info: {json.dumps(user_info.to_dict(), indent=2)}")
             # print(f"user_device_data: {json.dumps(user_device_data.to_dict(), indent=2)}")
             # print(f"mask_info: {json.dumps(mask_info.to_dict(), indent=2)}")
             # print(f"sleep_records: {json.dumps([record.to_dict() for record in sleep_records], indent=2)}")
+        except Exception:
+            # start from a fresh login on the next poll, the cached session may be what is failing
+            await self.clients.evict(user)
+            raise
+
+        if cached_user_info is None:
+            self.entities.put(user["username"], "patient", user_info)
+        if cached_mask_info is None:
+            self.entities.put(user["username"], "mask", mask_info)
+
+        previous = self.collector.get(user_info.id)
+        if not (device_changed or user_changed or mask_changed or sleep_records) and previous is not None:
+            # nothing changed since the last fetch: nothing to write, summarize or export again
+            self._update_sync_state(
+                user,
+                user_info.id,
+                full_sync,
+                self._sync_state[user["username"]].get("lastReportDate"),
+                user_device_data.lastSleepDataReportTime,
+            )
+            return user_device_data.lastSleepDataReportTime
+
+        # only what changed since the last fetch is written, a cached entity is already stored
+        writes = []
+        if device_changed:
+            writes.append(self.device_db.insert(user_device_data))
+        if user_changed:
+            writes.append(self.patient_db.insert(user_info))
+        if mask_changed:
+            writes.append(self.masks_db.insert(mask_info))
+        await asyncio.gather(*writes)
+
+        includeZero = self.config.settings.myair["include_zero_scores"]
+
+        if sleep_records is not None and len(sleep_records) > 0:
+            # a night keeps the mask it was first recorded with, new nights get the current mask
+            existing_mask_codes = await self.sleep_records_db.getMaskCodes(
+                user_info.id, [record.startDate for record in sleep_records]
+            )
+            for record in sleep_records:
+                record.maskCode = existing_mask_codes.get(record.startDate) or mask_info.maskCode
+
+            if await self.sleep_records_db.insert_many(sleep_records):
+                fingerprints["records"].update({date: record_fingerprints[date] for date in changed_dates})
+        # forget the nights that left the records window
+        fingerprints["records"] = {
+            date: value for date, value in fingerprints["records"].items() if date[:10] >= cutoff
+        }
+
+        # last report date, total usage and day counts in a single aggregation
+        summary = await self.sleep_records_db.getSummary(user_info.id)
+        lastReportDate = summary.lastReportDate
+
+        if lastReportDate is None:
+            yesterday: datetime.datetime = datetime.datetime.now() - datetime.timedelta(days=1)
+            lastReportDate = yesterday.strftime("%Y-%m-%d")
+
+        devices = await self._get_devices(user, user_info.id, user_device_data)
+        masks: typing.Optional[typing.List[Mask]] = self.entities.get(user["username"], "masks")
+        if masks is None or mask_changed:
+            # the mask catalog can only have changed when the mask info was fetched again
+            masks = await self.masks_db.list_by_patient(user_info.id) or []
+            self.entities.put(user["username"], "masks", masks)
+        self.collector.update(
+            self._build_snapshot(
+                user_info,
+                user_device_data,
+                mask_info,
+                devices,
+                masks,
+                sleep_records,
+                summary,
+                lastReportDate,
+                full_sync,
+                includeZero,
+                unchanged_dates,
+            )
+        )
+
+        self._update_sync_state(
+            user, user_info.id, full_sync, summary.lastReportDate, user_device_data.lastSleepDataReportTime
+        )
+        return user_device_data.lastSleepDataReportTime
+
+    def _update_sync_state(
+        self,
+        user,
+        patientId: str,
+        full_sync: bool,
+        lastReportDate: typing.Optional[str],
+        lastSleepDataReportTime: typing.Optional[str],
+    ) -> None:
+        if full_sync:
+            self._sync_state[user["username"]] = {"patientId": patientId, "lastFullSync": time.time()}
+        self._sync_state[user["username"]]["lastReportDate"] = lastReportDate
+        self._sync_state[user["username"]]["lastSleepDataReportTime"] = lastSleepDataReportTime
+        self._sync_state[user["username"]]["lastFetch"] = time.time()
+
+    @staticmethod
+    def _fingerprinted(
+        fingerprints: dict, kind: str, data: typing.Mapping[str, typing.Any], model: typing.Type[T]
+    ) -> typing.Tuple[T, bool]:
+        """The model for the response, rebuilt only when the response differs from the last one, and if it did"""
+        value = utils.fingerprint(data)
+        previous = fingerprints.get(kind)
+        if previous is not None and previous[0] == value:
+            return previous[1], False
+        instance = model.from_map(data)  # type: ignore
+        fingerprints[kind] = (value, instance)
+        return instance, True
+
+    async def _get_devices(self, user, patientId: str, user_device_data: SleepDevice) -> typing.List[SleepDevice]:
+        """The patient's device catalog, re-read on its TTL or as soon as the active device is not in it"""
+        devices: typing.Optional[typing.List[SleepDevice]] = self.entities.get(user["username"], "devices")
+        if devices is None or user_device_data.serialNumber not in [device.serialNumber for device in devices]:
+            devices = await self.device_db.list_by_patient(patientId) or []
+            self.entities.put(user["username"], "devices", devices)
+        return devices
+
+    def _build_snapshot(
+        self,
+        user_info: Patient,
+        user_device_data: SleepDevice,
+        mask_info: Mask,
+        devices: typing.List[SleepDevice],
+        masks: typing.List[Mask],
+        sleep_records: typing.List[SleepRecord],
+        summary: SleepSummary,
+        lastReportDate: str,
+        full_sync: bool,
+        includeZero: bool,
+        unchanged_dates: typing.Set[str],
+    ) -> PatientSnapshot:
+        """Build the patient's exported state from the changed nights on top of the previous snapshot's nights
+
+        An incremental poll keeps every night it did not fetch again, a full sync only the ones that did not change.
+        """
+        previous = self.collector.get(user_info.id)
+        nights: typing.Dict[str, Night] = {}
+        if previous is not None:
+            nights.update(
+                previous.nights
+                if not full_sync
+                else {date: night for date, night in previous.nights.items() if date in unchanged_dates}
+            )
+        for record in sleep_records or []:
+            if not includeZero and record.sleepScore == 0:
+                nights.pop(record.startDate, None)
+                continue
+            nights[record.startDate] = Night(
+                device=user_device_data.serialNumber,
+                mask=str(record.maskCode),
+                values=(
+                    record.sleepScore,
+                    record.totalUsage * 60,  # totalUsage is in minutes, convert to seconds
+                    record.usageScore,
+                    record.leakPercentile,
+                    record.leakScore,
+                    record.maskPairCount,
+                    record.maskScore,
+                    record.ahi,
+                    record.ahiScore,
+                ),
+            )
 
-            await client.close()
-
-            self.patient_db.insert(user_info)
-            self.device_db.insert(user_device_data)
-            self.masks_db.insert(mask_info)
-
-            lastReportDate = self.sleep_records_db.getLastReportDate(user_info.id)
-
-            if lastReportDate is None:
-                yesterday: datetime.datetime = datetime.datetime.now() - datetime.timedelta(days=1)
-                lastReportDate = yesterday.strftime("%Y-%m-%d")
-
-            includeZero = self.config.settings.myair["include_zero_scores"]
-
-            if sleep_records is not None and len(sleep_records) > 0:
-                for record in sleep_records:
-                    print(f"Processing record: {record.startDate} for patient: {record.sleepRecordPatientId}")
-
-                    entry_mask = mask_info
-
-                    existing_record = self.sleep_records_db.get(record.startDate, record.sleepRecordPatientId)
-                    if existing_record and existing_record.maskCode is not None:
-                        entry_mask = (
-                            self.masks_db.get(record.sleepRecordPatientId, existing_record.maskCode) or mask_info
-                        )
-
-                    record.maskCode = entry_mask.maskCode
-
-                    self.sleep_records_db.insert(record)
-
-                    if not includeZero and record.sleepScore == 0:
-                        continue
-
-                    self.score.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.sleepScore)
-
-                    self.usage.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(
-                        record.totalUsage * 60
-                    )  # totalUsage is in minutes, convert to seconds
-
-                    self.usage_score.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.usageScore)
-
-                    self.mask_seal.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.leakPercentile)
-
-                    self.mask_seal_score.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.leakScore)
-
-                    self.mask_onoff_count.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.maskPairCount)
-
-                    self.mask_onoff_score.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.maskScore)
-
-                    self.ahi.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.ahi)
-
-                    self.ahi_score.labels(
-                        patient=record.sleepRecordPatientId,
-                        device=user_device_data.serialNumber,
-                        date=record.startDate,
-                        mask=record.maskCode,
-                    ).set(record.ahiScore)
-
-            self.patient.labels(
-                id=user_info.id,
-                name=f"{user_info.firstName} {user_info.lastName[:1]}",
-                ahi=user_info.userEnteredAhi or 0,
-            ).set(1)
-
-            devices = self.device_db.list() or []
-            for device in devices:
-                active = device.serialNumber == user_device_data.serialNumber
-
-                deviceLastReportDate = (
-                    datetime.datetime.fromisoformat(device.lastSleepDataReportTime).strftime("%Y-%m-%d")
-                    if device.lastSleepDataReportTime
-                    else None
+        device_series = []
+        for device in devices:
+            active = device.serialNumber == user_device_data.serialNumber
+            deviceLastReportDate = (
+                datetime.datetime.fromisoformat(device.lastSleepDataReportTime).strftime("%Y-%m-%d")
+                if device.lastSleepDataReportTime
+                else None
+            )
+            device_series.append(
+                (
+                    (
+                        device.serialNumber,
+                        device.fgDeviceManufacturerName,
+                        device.deviceType,
+                        device.localizedName,
+                        device.imagePath,
+                        lastReportDate if active else deviceLastReportDate,
+                        device.fgDevicePatientId,
+                    ),
+                    1 if active else 0,
                 )
+            )
 
-                self.device.labels(
-                    serialNumber=device.serialNumber,
-                    manufacturer=device.fgDeviceManufacturerName,
-                    type=device.deviceType,
-                    name=device.localizedName,
-                    image=device.imagePath,
-                    lastReportDate=lastReportDate if active else deviceLastReportDate,
-                    patient=device.fgDevicePatientId,
-                ).set(1 if active else 0)
-
-            usageSeconds = self.sleep_records_db.getTotalUsageSeconds(patientId=device.fgDevicePatientId)
-            self.total_usage_seconds.clear()
-            usageSeconds = self.sleep_records_db.getTotalUsageSeconds(patientId=user_device_data.fgDevicePatientId)
-            self.total_usage_seconds.clear()
-            self.total_usage_seconds.labels(patient=user_device_data.fgDevicePatientId).set(usageSeconds)
-
-            masks = self.masks_db.list() or []
-            for mask in masks:
-                active = mask.maskCode == mask_info.maskCode
-                self.mask.labels(
-                    patient=mask.maskPatientId,
-                    code=mask.maskCode,
-                    name=mask.localizedName,
-                    type=mask.maskType,
-                    image=mask.imagePath,
-                ).set(1 if active else 0)
-
-            totalDays = self.sleep_records_db.getTotalDaysCount(user_info.id, includeZero=includeZero)
-            self.total_days_count.clear()
-            self.total_days_count.labels(
-                patient=user_info.id,
-                device=user_device_data.serialNumber,
-                mask=mask_info.maskCode,
-                lastReportDate=lastReportDate,
-            ).set(totalDays)
+        mask_series = [
+            (
+                (mask.maskPatientId, mask.maskCode, mask.localizedName, mask.maskType, mask.imagePath),
+                1 if mask.maskCode == mask_info.maskCode else 0,
+            )
+            for mask in masks
+        ]
+
+        return PatientSnapshot(
+            patientId=user_info.id,
+            patient=(
+                user_info.id,
+                f"{user_info.firstName} {user_info.lastName[:1]}",
+                str(user_info.userEnteredAhi or 0),
+            ),
+            devices=[(tuple(str(label) for label in labels), active) for labels, active in device_series],
+            masks=[(tuple(str(label) for label in labels), active) for labels, active in mask_series],
+            nights=nights,
+            total_days=(
+                (user_info.id, user_device_data.serialNumber, str(mask_info.maskCode), lastReportDate),
+                summary.daysCount(includeZero=includeZero),
+            ),
+            total_usage_seconds=summary.totalUsageSeconds,
+        )
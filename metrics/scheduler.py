@@ -0,0 +1,136 @@
+import datetime
+import random
+import time
+import typing
+
+from libs import utils
+from prometheus_client import Counter, Gauge
+
+# a CPAP uploads the previous night roughly once a day
+UPLOAD_PERIOD_SECONDS = 86400
+
+POLL_NEXT_DUE = Gauge(
+    namespace="myair",
+    subsystem="exporter",
+    name="poll_next_due_timestamp_seconds",
+    documentation="Unix time the next poll of the user is due, the user label being a hash of the account",
+    labelnames=["user"],
+)
+
+POLL_INTERVAL = Gauge(
+    namespace="myair",
+    subsystem="exporter",
+    name="poll_interval_seconds",
+    documentation="Current delay between polls of the user, before jitter",
+    labelnames=["user"],
+)
+
+POLLS = Counter(
+    namespace="myair",
+    subsystem="exporter",
+    name="polls",
+    documentation="Number of user polls by result: new_data, no_change or failed",
+    labelnames=["result"],
+)
+
+
+class UserSchedule:
+    def __init__(self, key: str, interval: float) -> None:
+        self.key = key
+        self.next_due = 0.0
+        self.interval = interval
+        # the device's lastSleepDataReportTime at the last successful poll
+        self.last_report_time: typing.Optional[str] = None
+        # unix time the next upload is expected, a day after the last one
+        self.expected_upload: typing.Optional[float] = None
+
+
+class PollScheduler:
+    """Keeps a next-due time per user: fast polls around the expected upload, exponential back-off otherwise"""
+
+    def __init__(self, min_interval: float, max_interval: float, upload_window: float, jitter: float) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        # seconds either side of the expected upload polled every min_interval
+        self.upload_window = upload_window
+        self.jitter = jitter
+        self._schedules: typing.Dict[str, UserSchedule] = {}
+
+    @staticmethod
+    def _key(user: dict) -> str:
+        # also the user label, /metrics must not carry the account's email address
+        return utils.user_hash(user)
+
+    def _get(self, user: dict) -> UserSchedule:
+        key = self._key(user)
+        schedule = self._schedules.get(key)
+        if schedule is None:
+            # a new user is due right away
+            schedule = UserSchedule(key, self.min_interval)
+            self._schedules[key] = schedule
+        return schedule
+
+    def due(self, users: typing.List[dict], now: typing.Optional[float] = None) -> typing.List[dict]:
+        """The users whose next poll is due"""
+        now = time.time() if now is None else now
+        return [user for user in users if self._get(user).next_due <= now]
+
+    def next_due(self, users: typing.List[dict]) -> float:
+        """Unix time the next user is due"""
+        return min((self._get(user).next_due for user in users), default=time.time() + self.min_interval)
+
+    def completed(self, user: dict, report_time: typing.Optional[str], now: typing.Optional[float] = None) -> None:
+        """Schedule the next poll after a successful one, report_time being the device's lastSleepDataReportTime"""
+        now = time.time() if now is None else now
+        schedule = self._get(user)
+        new_data = report_time is not None and report_time != schedule.last_report_time
+        POLLS.labels(result="new_data" if new_data else "no_change").inc()
+        if new_data:
+            schedule.last_report_time = report_time
+            schedule.expected_upload = self._parse_report_time(report_time) + UPLOAD_PERIOD_SECONDS
+            # back off again from the fast interval, picking up late corrections to the new night first
+            schedule.interval = self.min_interval
+        elif self._in_upload_window(schedule, now):
+            schedule.interval = self.min_interval
+        else:
+            schedule.interval = min(schedule.interval * 2, self.max_interval)
+            # a night without an upload, expect the next one at the same time tomorrow
+            while schedule.expected_upload is not None and now > schedule.expected_upload + self.upload_window:
+                schedule.expected_upload += UPLOAD_PERIOD_SECONDS
+
+        delay = self._jittered(schedule.interval)
+        if schedule.expected_upload is not None:
+            window_start = schedule.expected_upload - self.upload_window
+            # never back off past the start of the next upload window
+            if now < window_start:
+                delay = min(delay, window_start - now)
+        self._set_next_due(schedule, now + delay)
+
+    def failed(self, user: dict, now: typing.Optional[float] = None) -> None:
+        """Back off exponentially after a failed poll"""
+        now = time.time() if now is None else now
+        schedule = self._get(user)
+        POLLS.labels(result="failed").inc()
+        schedule.interval = min(schedule.interval * 2, self.max_interval)
+        self._set_next_due(schedule, now + self._jittered(schedule.interval))
+
+    def _in_upload_window(self, schedule: UserSchedule, now: float) -> bool:
+        if schedule.expected_upload is None:
+            return False
+        return abs(now - schedule.expected_upload) <= self.upload_window
+
+    def _jittered(self, interval: float) -> float:
+        # spread users out so they do not all hit myAir at the same second
+        return max(0.0, interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def _set_next_due(self, schedule: UserSchedule, next_due: float) -> None:
+        schedule.next_due = next_due
+        POLL_NEXT_DUE.labels(user=schedule.key).set(next_due)
+        POLL_INTERVAL.labels(user=schedule.key).set(schedule.interval)
+
+    @staticmethod
+    def _parse_report_time(report_time: str) -> float:
+        reported = datetime.datetime.fromisoformat(report_time)
+        if reported.tzinfo is None:
+            reported = reported.replace(tzinfo=datetime.timezone.utc)
+        return reported.timestamp()
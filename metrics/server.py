@@ -0,0 +1,82 @@
+import os
+import time
+import typing
+
+from aiohttp import web
+from libs import settings
+from libs.enums.loglevel import LogLevel
+from libs.logger import Log
+from metrics.exposition import ExpositionCache
+from prometheus_client import CONTENT_TYPE_LATEST
+
+
+class MetricsServer:
+    """Serves /metrics, /healthz and /readyz from the exporter's own event loop"""
+
+    def __init__(self, port: int, cache: ExpositionCache, app_metrics, addr: str = "0.0.0.0") -> None:
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        _method = f"{self._module}.{self._class}.__init__"
+
+        self.settings = settings.Settings()
+        log_level = LogLevel[self.settings.log_level.upper()]
+        if not log_level:
+            log_level = LogLevel.DEBUG
+        self.log = Log(minimumLogLevel=log_level)
+
+        self.port = port
+        self.addr = addr
+        self.cache = cache
+        self.app_metrics = app_metrics
+        self.started_at = time.time()
+
+        # admin routes are added to the same application
+        self.app = web.Application()
+        self.app.router.add_get("/", self.metrics)
+        self.app.router.add_get("/metrics", self.metrics)
+        self.app.router.add_get("/healthz", self.healthz)
+        self.app.router.add_get("/readyz", self.readyz)
+        self._runner: typing.Optional[web.AppRunner] = None
+
+        self.log.debug(_method, "Server initialized")
+
+    async def start(self) -> None:
+        _method = f"{self._module}.{self._class}.start"
+        # scrapes are frequent, do not log every request
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.addr, self.port).start()
+        self.log.info(_method, f"Exporter Starting Listen => :{self.port}/metrics")
+
+    async def stop(self) -> None:
+        """Stop accepting connections and close the open ones"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        rendered = self.cache.get()
+        compressed = "gzip" in request.headers.get("Accept-Encoding", "")
+        etag = rendered.gzip_etag if compressed else rendered.etag
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+            return web.Response(status=304, headers=headers)
+
+        body = rendered.body
+        if compressed:
+            body = rendered.gzip_body
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Type"] = CONTENT_TYPE_LATEST
+        # served as-is, the gzip variant is compressed once per render rather than per request
+        return web.Response(body=body, headers=headers)
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        """Liveness, answering at all means the event loop is not blocked"""
+        return web.json_response({"status": "ok", "uptime": time.time() - self.started_at})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        """Readiness, once the first poll cycle has completed"""
+        last_fetch = self.app_metrics.last_fetch
+        if last_fetch is None:
+            return web.json_response({"status": "starting"}, status=503)
+        return web.json_response({"status": "ok", "lastFetch": last_fetch})
@@ -0,0 +1,222 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import traceback
+import typing
+
+from libs import settings
+from libs.enums.loglevel import LogLevel
+from libs.logger import Log
+from libs.logsink import LogSink
+from libs.mongodb.MyAirLogsDatabase import MyAirLogsDatabase
+from metrics.collector import NAMESPACE, MyAirCollector
+from metrics.config import MyAirMetricsConfig
+from prometheus_client import REGISTRY
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector, CollectorRegistry
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# delay before restarting a worker that died, doubled on every death in a row up to the maximum
+RESTART_BACKOFF_SECONDS = 1.0
+RESTART_BACKOFF_MAX_SECONDS = 300.0
+
+
+def partition_users(users: typing.List[dict], index: int, count: int) -> typing.List[dict]:
+    """The users polled by worker index of count, stable across restarts whatever the environment order"""
+    return sorted(users, key=lambda user: (user["region"], user["username"]))[index::count]
+
+
+def run_worker(index: int, count: int, messages: multiprocessing.Queue) -> None:
+    """Entry point of a worker process: poll a partition of the users on its own event loop and client cache"""
+    # the parent handles Ctrl+C and terminates the workers, a worker only reacts to SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if uvloop is not None:
+        raise SystemExit(uvloop.run(_worker(index, count, messages)))
+    raise SystemExit(asyncio.run(_worker(index, count, messages)))
+
+
+async def _worker(index: int, count: int, messages: multiprocessing.Queue) -> int:
+    _method = "workers._worker"
+    # imported here, a spawned worker only pulls in the polling side once it runs
+    from metrics.exporter import MetricsExporter
+    from metrics.myair import MyAirMetrics
+
+    exporter = MetricsExporter()
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)  # type: ignore
+
+    app_metrics = None
+    forwarder = None
+    try:
+        LogSink.get_instance().start(MyAirLogsDatabase().insert_logs)
+        config = MyAirMetricsConfig("metrics/config.yml")
+        config.settings.myair["users"] = partition_users(config.settings.myair["users"], index, count)
+        app_metrics = MyAirMetrics(config)
+        app_metrics.collector.on_update = lambda snapshot: messages.put(("snapshot", index, snapshot))
+        # the nights reach the parent as snapshots, REGISTRY only holds the worker's own metrics
+        forwarder = asyncio.create_task(_forward_metrics(index, messages, config.metrics["cacheMaxAge"]))
+        await app_metrics.ensure_schema()
+        await app_metrics.run_metrics_loop(on_fetch=lambda completed: messages.put(("fetch", index, completed)))
+    except asyncio.CancelledError:
+        pass
+    except Exception as ex:
+        exporter.exit_code = 1
+        exporter.log.error(_method, str(ex), traceback.format_exc())
+    finally:
+        if forwarder is not None:
+            forwarder.cancel()
+        if not await exporter.shutdown(None, app_metrics):
+            exporter.exit_code = 1
+    return exporter.exit_code
+
+
+async def _forward_metrics(index: int, messages: multiprocessing.Queue, interval: float) -> None:
+    """Send the worker's own metrics (polls, probes, limiter, spans, ...) to the parent every interval"""
+    while True:
+        messages.put(("metrics", index, list(REGISTRY.collect())))
+        await asyncio.sleep(interval)
+
+
+# families the parent's collector already exports for every worker's snapshots, a worker's copy would count twice
+PARENT_FAMILIES = {f"{NAMESPACE}_exporter_series"}
+
+
+class WorkerMetricsCollector(Collector):
+    """The parent's own metrics merged with the latest ones each worker forwarded, told apart by a worker label"""
+
+    def __init__(self, registry: CollectorRegistry, pool: "WorkerPool") -> None:
+        self.registry = registry
+        self.pool = pool
+
+    def collect(self) -> typing.Iterable[Metric]:
+        # one family per name, a family both processes export must not be rendered twice
+        families: typing.Dict[str, Metric] = {}
+        for family in self.registry.collect():
+            merged = Metric(family.name, family.documentation, family.type, family.unit)
+            merged.samples = list(family.samples)
+            families[family.name] = merged
+        for index, worker_families in sorted(self.pool.metrics.items()):
+            for family in worker_families:
+                if family.name in PARENT_FAMILIES:
+                    continue
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = Metric(family.name, family.documentation, family.type, family.unit)
+                    families[family.name] = merged
+                merged.samples.extend(
+                    sample._replace(labels={**sample.labels, "worker": str(index)}) for sample in family.samples
+                )
+        return families.values()
+
+
+class WorkerPool:
+    """Spreads the users over worker processes and merges their snapshots into the parent's collector"""
+
+    def __init__(self, count: int, collector: MyAirCollector) -> None:
+        self._module = os.path.basename(__file__)[:-3]
+        self._class = self.__class__.__name__
+        _method = f"{self._module}.{self._class}.__init__"
+
+        self.settings = settings.Settings()
+        log_level = LogLevel[self.settings.log_level.upper()]
+        if not log_level:
+            log_level = LogLevel.DEBUG
+        self.log = Log(minimumLogLevel=log_level)
+
+        self.count = count
+        self.collector = collector
+        # spawn, a forked child would inherit the parent's event loop, sockets and MongoDB client
+        self._context = multiprocessing.get_context("spawn")
+        self._messages: multiprocessing.Queue = self._context.Queue()
+        self._processes: typing.List[typing.Optional[multiprocessing.process.BaseProcess]] = [None] * count
+        self._fetched: typing.Dict[int, float] = {}
+        # deaths in a row of each worker, reset once it completes a poll cycle, and when it may be restarted
+        self._failures: typing.Dict[int, int] = {}
+        self._restart_at: typing.Dict[int, float] = {}
+        # the metric families each worker forwarded last
+        self.metrics: typing.Dict[int, typing.List[Metric]] = {}
+        # unix time every worker had completed a poll cycle, None until then
+        self.last_fetch: typing.Optional[float] = None
+
+        self.log.debug(_method, f"Worker pool initialized with {count} workers")
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker, args=(index, self.count, self._messages), name=f"myair-worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def run(self) -> None:
+        """Start the workers, then merge their messages and restart any worker that died until cancelled"""
+        _method = f"{self._module}.{self._class}.run"
+        for index in range(self.count):
+            self._spawn(index)
+        loop = asyncio.get_running_loop()
+        while True:
+            self._drain()
+            now = loop.time()
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    # a worker failing at startup must not turn into a spawn loop
+                    failures = self._failures.get(index, 0) + 1
+                    self._failures[index] = failures
+                    delay = min(RESTART_BACKOFF_SECONDS * 2 ** (failures - 1), RESTART_BACKOFF_MAX_SECONDS)
+                    if failures == 1:
+                        self.log.warn(_method, f"Worker {index} exited with {process.exitcode}, restarting")
+                    else:
+                        self.log.debug(_method, f"Worker {index} exited again, restarting in {delay:.0f} seconds")
+                    process.join(timeout=0)
+                    self._processes[index] = None
+                    # a restarted worker starts its counters over
+                    self.metrics.pop(index, None)
+                    self._restart_at[index] = now + delay
+                elif process is None and now >= self._restart_at.get(index, now):
+                    self._restart_at.pop(index, None)
+                    self._spawn(index)
+            await asyncio.sleep(0.5)
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                kind, index, payload = self._messages.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "snapshot":
+                self.collector.update(payload)
+            elif kind == "metrics":
+                self.metrics[index] = payload
+            elif kind == "fetch":
+                if self._failures.pop(index, None):
+                    self.log.info(f"{self._module}.{self._class}._drain", f"Worker {index} recovered")
+                self._fetched[index] = payload
+                if len(self._fetched) == self.count:
+                    self.last_fetch = min(self._fetched.values())
+
+    async def stop(self) -> None:
+        """Ask every worker to drain and exit, killing the ones still running once cancelled"""
+        _method = f"{self._module}.{self._class}.stop"
+        processes = [process for process in self._processes if process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        try:
+            while any(process.is_alive() for process in processes):
+                await asyncio.sleep(0.1)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    self.log.warn(_method, f"Killing {process.name}, it did not exit in time")
+                    process.kill()
+                process.join(timeout=1)
+            self._drain()
+            self._messages.close()
+            self._processes = [None] * self.count